@@ -0,0 +1,172 @@
+"""A local stand-in for the Gengo API, with configurable latency."""
+
+import BaseHTTPServer
+import json
+import re
+import threading
+import time
+import urlparse
+from SocketServer import ThreadingMixIn
+
+
+def posted_jobs(data):
+    """The jobs in a POST, which may be a list or a dict"""
+    jobs = data['jobs']
+    if isinstance(jobs, dict):
+        return jobs.values()
+    return jobs
+
+
+class FakeGengoServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves the Gengo API endpoints that gengogettext uses, from jobs, a
+    {job id: job data} dict. Every response is delayed by latency seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeGengoHandler)
+        self.latency = latency
+        self.jobs = {}
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    @property
+    def api_url(self):
+        return 'http://%s:%i/%%(version)s' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_job(self, job_id, lang, source, translation='',
+                status='reviewable', order_id=1, ctime=None):
+        self.jobs[int(job_id)] = {
+            'job_id': str(job_id),
+            'order_id': str(order_id),
+            'lc_tgt': lang,
+            'body_src': source,
+            'body_tgt': translation,
+            'status': status,
+            'ctime': ctime or int(time.time()),
+        }
+
+    # Endpoints. Each takes the URL match, query and POSTed data and returns
+    # the response.
+
+    def get_jobs(self, match, query, data):
+        count = int(query.get('count', 10))
+        after = int(query.get('timestamp_after', 0))
+        jobs = sorted((job for job in self.jobs.itervalues()
+                       if job['ctime'] > after),
+                      key=lambda job: job['ctime'], reverse=True)
+        return [{'job_id': job['job_id'], 'ctime': job['ctime']}
+                for job in jobs[:count]]
+
+    def get_job_batch(self, match, query, data):
+        ids = [int(id) for id in match.group(1).split(',')]
+        return {'jobs': [self.jobs[id] for id in ids if id in self.jobs]}
+
+    def update_job(self, match, query, data):
+        job = self.jobs.get(int(match.group(1)))
+        if job and data.get('action') == 'approve':
+            job['status'] = 'approved'
+        return {}
+
+    def get_comments(self, match, query, data):
+        return {'thread': [{'body': 'Job posted', 'author': 'customer',
+                            'ctime': int(time.time())}]}
+
+    def quote(self, match, query, data):
+        return {'jobs': [{'currency': 'USD', 'credits': '0.05'}
+                         for job in posted_jobs(data)]}
+
+    def post_jobs(self, match, query, data):
+        with self.lock:
+            order_id = len(self.orders) + 1
+            ids = []
+            for job in posted_jobs(data):
+                job_id = len(self.jobs) + 1
+                self.add_job(job_id, job['lc_tgt'], job['body_src'],
+                             status='available', order_id=order_id)
+                ids.append(str(job_id))
+            self.orders[order_id] = ids
+        return {'order_id': order_id, 'job_count': len(ids)}
+
+    def get_order(self, match, query, data):
+        ids = self.orders.get(int(match.group(1)), [])
+        return {'order': {
+            'order_id': match.group(1),
+            'total_jobs': str(len(ids)),
+            'jobs_queued': '0',
+            'jobs_available': ids,
+            'jobs_approved': [],
+        }}
+
+    routes = [
+        ('GET', r'/translate/jobs$', get_jobs),
+        ('GET', r'/translate/jobs/([\d,]+)$', get_job_batch),
+        ('PUT', r'/translate/job/(\d+)$', update_job),
+        ('GET', r'/translate/job/(\d+)/comments$', get_comments),
+        ('POST', r'/translate/service/quote$', quote),
+        ('POST', r'/translate/jobs$', post_jobs),
+        ('GET', r'/translate/order/(\d+)$', get_order),
+    ]
+
+
+class FakeGengoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        query.update(urlparse.parse_qsl(body))
+        data = json.loads(query['data']) if 'data' in query else {}
+        path = re.sub(r'^/v[\d.]+', '', url.path)
+
+        time.sleep(server.latency)
+        for route_method, pattern, endpoint in server.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                response = json.dumps({
+                    'opstat': 'ok',
+                    'response': endpoint(server, match, query, data),
+                })
+                status = 200
+                break
+        else:
+            response = json.dumps({'opstat': 'error', 'err': {
+                'code': 404, 'msg': 'Unknown endpoint %s %s' % (method, path),
+            }})
+            status = 404
+
+        with server.lock:
+            server.requests += 1
+            server.bytes_received += len(self.path) + len(body)
+            server.bytes_sent += len(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
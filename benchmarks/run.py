@@ -0,0 +1,308 @@
+"""
+Benchmark the scan, sync and review pipelines against synthetic catalogs
+and a local fake Gengo API.
+
+Usage: python -m benchmarks.run --languages 40 --messages 15000
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+from gengo import Gengo
+import polib
+
+import gengogettext
+import orm
+from benchmarks.fake_gengo import FakeGengoServer
+from orm import Job
+
+LANGUAGES = ('ar', 'da', 'de', 'es', 'fi', 'fr', 'hu', 'it', 'ja', 'ko', 'nb',
+             'nl', 'pl', 'pt_BR', 'ru', 'sv', 'tr', 'uk', 'zh_CN', 'zh_TW')
+
+
+def get_languages(n):
+    """Return n language codes"""
+    languages = list(LANGUAGES[:n])
+    while len(languages) < n:
+        languages.append('x%i' % len(languages))
+    return languages
+
+
+def get_messages(n, seed=0):
+    """Return n distinct, random-ish source messages"""
+    rng = random.Random(seed)
+    words = [''.join(rng.choice(string.ascii_lowercase)
+                     for _ in range(rng.randint(2, 9)))
+             for _ in range(2000)]
+    decorations = ('%s', '%(name)s', '<b>', '{count}', '&amp;', '{{user}}')
+    messages = []
+    for i in range(n):
+        message = ' '.join(rng.choice(words)
+                           for _ in range(rng.randint(1, 12)))
+        if rng.random() < 0.2:
+            message += ' ' + rng.choice(decorations)
+        messages.append(u'%s %i' % (message, i))
+    return messages
+
+
+def translate(message, lang):
+    return u'[%s] %s' % (lang, message)
+
+
+def write_po_catalogs(locale_dir, domain, languages, messages, translated):
+    """
+    Write a .po catalog for every language, with the first translated
+    fraction of messages translated
+    """
+    for lang in languages:
+        po = polib.POFile()
+        po.metadata = {'Content-Type': 'text/plain; charset=UTF-8',
+                       'Language': lang}
+        cutoff = int(len(messages) * translated)
+        for i, message in enumerate(messages):
+            po.append(polib.POEntry(
+                msgid=message,
+                msgstr=translate(message, lang) if i < cutoff else u'',
+                occurrences=[('src/file%i.py' % (i % 50), str(i))],
+            ))
+        filename = gengogettext.po_file(locale_dir, lang, domain)
+        os.makedirs(os.path.dirname(filename))
+        po.save(filename)
+
+
+def write_json_catalogs(locale_dir, languages, messages, translated):
+    """
+    Write en.json and a JSON catalog for every language, with the first
+    translated fraction of messages translated
+    """
+    os.makedirs(locale_dir)
+    with open(gengogettext.json_file(locale_dir, 'en'), 'w') as f:
+        json.dump(dict((message, message) for message in messages), f)
+    cutoff = int(len(messages) * translated)
+    for lang in languages:
+        gengogettext.write_json_file(
+            gengogettext.json_file(locale_dir, lang),
+            dict((message, translate(message, lang))
+                 for message in messages[:cutoff]))
+
+
+def add_jobs(server, languages, messages, first, last, status):
+    """
+    Record jobs for messages[first:last] in every language, in the DB and
+    on the server
+    """
+    jobs = []
+    for lang in languages:
+        for message in messages[first:last]:
+            job_id = len(server.jobs) + 1
+            server.add_job(job_id, gengogettext.locale_to_gengo_language(
+                lang)[0], message, translate(message, lang), status)
+            jobs.append(Job(job_id, 1, lang, message, None, 'available'))
+    return jobs
+
+
+def reset_peak_rss():
+    """
+    Start measuring the peak resident set size afresh, if the OS lets us
+    (Linux does). Return whether it did.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        return False
+    return True
+
+
+def read_status(field):
+    """A memory field of /proc/self/status, in MiB, or None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def rss():
+    """Resident set size of this process, in MiB, or None if unknown"""
+    return read_status('VmRSS')
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process, in MiB, since reset_peak_rss()
+    if that worked, or since it started
+    """
+    peak = read_status('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return peak
+
+
+class Phases(object):
+    """
+    Collects wall time, CPU time, peak memory and memory growth (the peak
+    above the memory in use when the phase started) for named phases.
+    Where the peak can't be reset between phases, it is cumulative: the
+    peak of the run so far, and growth isn't measured.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    @contextlib.contextmanager
+    def measure(self, name, server=None):
+        requests = server.requests if server else 0
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        per_phase = reset_peak_rss()
+        start_rss = rss()
+        cpu = sum(os.times()[:2])
+        start = time.time()
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            cpu = sum(os.times()[:2]) - cpu
+            sys.stdout.close()
+            sys.stdout = stdout
+            self.results.append({
+                'phase': name,
+                'wall': wall,
+                'cpu': cpu,
+                'peak_rss_mib': peak_rss(),
+                'peak_rss_cumulative': not per_phase,
+                'rss_growth_mib': (peak_rss() - start_rss
+                                   if per_phase and start_rss is not None
+                                   else None),
+                'api_requests': (server.requests - requests) if server else 0,
+            })
+
+    def report(self):
+        print '%-20s %10s %10s %12s %12s %8s' % (
+            'phase', 'wall (s)', 'cpu (s)', 'peak (MiB)', 'growth (MiB)',
+            'requests')
+        for result in self.results:
+            growth = result['rss_growth_mib']
+            print '%-20s %10.3f %10.3f %11.1f%s %12s %8i' % (
+                result['phase'], result['wall'], result['cpu'],
+                result['peak_rss_mib'],
+                '*' if result['peak_rss_cumulative'] else ' ',
+                '-' if growth is None else '%.1f' % growth,
+                result['api_requests'])
+        if any(result['peak_rss_cumulative'] for result in self.results):
+            print '* Peak of the whole run so far, not of the phase'
+
+
+def run(args, workdir):
+    languages = get_languages(args.languages)
+    messages = get_messages(args.messages, args.seed)
+    phases = Phases()
+
+    server = FakeGengoServer(latency=args.latency).start()
+    gengogettext._gengo = Gengo(public_key='public', private_key='private',
+                                api_url=server.api_url)
+    gengogettext.CONCURRENCY = args.concurrency
+    orm.db = None
+    orm.DB_NAME = os.path.join(workdir, 'jobs.db')
+
+    # 40% translated, 20% approved in Gengo, 20% in progress, 20% new
+    approved_until = int(args.messages * 0.6)
+    in_progress_until = int(args.messages * 0.8)
+    po_dir = os.path.join(workdir, 'po')
+    json_dir = os.path.join(workdir, 'json')
+    with phases.measure('generate'):
+        write_po_catalogs(po_dir, 'messages', languages, messages, 0.4)
+        write_json_catalogs(json_dir, languages, messages, 0.4)
+        jobs = add_jobs(server, languages, messages, int(args.messages * 0.4),
+                        approved_until, 'approved')
+        jobs += add_jobs(server, languages, messages, approved_until,
+                         in_progress_until, 'reviewable')
+
+    with phases.measure('orm: save_many'):
+        Job.save_many(jobs)
+    del jobs
+
+    with phases.measure('sync: statuses', server):
+        gengogettext.update_statuses()
+
+    with phases.measure('review: checks'):
+        for job in Job.get_reviewable():
+            gengogettext.check_translation(job)
+    with phases.measure('review: queue', server):
+        gengogettext.queue_reviews()
+
+    with phases.measure('orm: get_index'):
+        for lang in languages:
+            Job.get_index(lang)
+
+    po_walks = [(lang, gengogettext.po_file(po_dir, lang, 'messages'),
+                 gengogettext.walk_po_file,
+                 (po_dir, lang, 'messages', False))
+                for lang in languages]
+    with phases.measure('scan: po'):
+        gengogettext.walk_catalogs(po_walks)
+    with phases.measure('scan: po, unchanged'):
+        gengogettext.walk_catalogs(po_walks)
+    if args.jobs > 1:
+        gengogettext.FULL_SCAN = True
+        with phases.measure('scan: po, %i jobs' % args.jobs):
+            gengogettext.walk_catalogs_in_parallel(po_walks, args.jobs)
+        gengogettext.FULL_SCAN = False
+
+    with phases.measure('scan: json'):
+        gengogettext.walk_json_files(json_dir, languages, False)
+    with phases.measure('scan: json, unchanged'):
+        gengogettext.walk_json_files(json_dir, languages, False)
+
+    server.stop()
+    return phases
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    p.add_argument('--languages', type=int, default=10,
+                   help='Number of languages (default: 10)')
+    p.add_argument('--messages', type=int, default=1000,
+                   help='Number of messages per catalog (default: 1000)')
+    p.add_argument('--latency', type=float, default=0.05,
+                   help='Fake Gengo API latency, in seconds (default: 0.05)')
+    p.add_argument('--concurrency', type=int,
+                   default=gengogettext.CONCURRENCY,
+                   help='Simultaneous API requests (default: %i)'
+                        % gengogettext.CONCURRENCY)
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='Also time a parallel scan, in this many processes')
+    p.add_argument('--seed', type=int, default=0,
+                   help='Random seed for the synthetic messages')
+    p.add_argument('--json', action='store_true',
+                   help='Report as JSON')
+    args = p.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gengogettext-bench-')
+    try:
+        phases = run(args, workdir)
+    finally:
+        orm.db = None
+        shutil.rmtree(workdir)
+
+    if args.json:
+        print json.dumps(phases.results, indent=2)
+    else:
+        phases.report()
+
+
+if __name__ == '__main__':
+    main()
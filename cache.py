@@ -0,0 +1,129 @@
+"""
+An on-disk cache for Gengo API responses that don't change, or change
+slowly, so that repeated and resumed runs can skip the round trips.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+DAY = 24 * 60 * 60
+# Seconds to keep each method's responses
+TTLS = {
+    'getTranslationJobComments': 60 * 60,
+    'determineTranslationCost': DAY,
+}
+# Jobs in these states never change again
+FINAL_STATUSES = ('approved', 'canceled')
+FINAL_JOB_TTL = 30 * DAY
+
+
+def cache_key(method, kwargs):
+    return hashlib.sha1('%s %s' % (
+        method, json.dumps(kwargs, sort_keys=True))).hexdigest()
+
+
+class ResponseCache(object):
+    """
+    JSON values in a SQLite database, that expire after a TTL. When it's
+    opened, expired values are dropped, and beyond max_entries, the least
+    recently used ones are evicted.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, filename, max_entries=100000):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode = WAL;')
+            self.db.execute(
+                """CREATE TABLE IF NOT EXISTS response (
+                        key TEXT PRIMARY KEY,
+                        value TEXT,
+                        expires REAL,
+                        used REAL
+                    );""")
+            self.db.execute('CREATE INDEX IF NOT EXISTS response_used '
+                            'ON response (used);')
+            self.db.execute('DELETE FROM response WHERE expires < ?;',
+                            (time.time(),))
+            self.db.execute(
+                """DELETE FROM response WHERE key IN (
+                       SELECT key FROM response ORDER BY used DESC
+                       LIMIT -1 OFFSET ?);""", (max_entries,))
+
+    def get(self, key):
+        """Return the value stored for key, or None"""
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT value FROM response WHERE key = ? AND expires >= ?;',
+                (key, now)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE response SET used = ? WHERE key = ?;',
+                            (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('REPLACE INTO response VALUES (?, ?, ?, ?);',
+                            (key, json.dumps(value), now + ttl, now))
+
+    def close(self):
+        self.db.close()
+
+
+class CachingClient(object):
+    """
+    Wraps a Gengo client, answering from cache what it can:
+    comments and quotes for a while (TTLS), and jobs that have reached
+    a final status for FINAL_JOB_TTL.
+    """
+
+    def __init__(self, client, cache, ttls=TTLS):
+        self._client = client
+        self._cache = cache
+        self._ttls = ttls
+
+    def __getattr__(self, method):
+        call = getattr(self._client, method)
+        if method == 'getTranslationJobBatch':
+            return lambda **kwargs: self._job_batch(call, **kwargs)
+        ttl = self._ttls.get(method)
+        if not ttl:
+            return call
+
+        def cached(**kwargs):
+            key = cache_key(method, kwargs)
+            result = self._cache.get(key)
+            if result is None:
+                result = call(**kwargs)
+                self._cache.set(key, result, ttl)
+            return result
+        return cached
+
+    def _job_batch(self, call, id):
+        """getTranslationJobBatch, only fetching the jobs we don't have"""
+        jobs = []
+        missing = []
+        for job_id in id.split(','):
+            job = self._cache.get(cache_key('job', job_id))
+            if job is None:
+                missing.append(job_id)
+            else:
+                jobs.append(job)
+        if not missing:
+            return {'opstat': 'ok', 'response': {'jobs': jobs}}
+
+        result = call(id=','.join(missing))
+        for job in result['response']['jobs']:
+            if job['status'] in FINAL_STATUSES:
+                self._cache.set(cache_key('job', str(job['job_id'])), job,
+                                FINAL_JOB_TTL)
+        result['response']['jobs'] = jobs + result['response']['jobs']
+        return result
@@ -0,0 +1,41 @@
+"""A local HTTP endpoint for Gengo's job callbacks, for watch mode"""
+
+import BaseHTTPServer
+import json
+import threading
+import urlparse
+
+
+class CallbackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Receives Gengo's job callbacks, and queues the job ids on
+    server.job_ids. The callbacks are only trusted as hints: the jobs are
+    fetched from the API.
+    """
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        try:
+            job = json.loads(form['job'][0])
+            self.server.job_ids.put(int(job['job_id']))
+        except (KeyError, TypeError, ValueError):
+            pass
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+def start_callback_server(port, job_ids, verbose=False):
+    """Serve Gengo callbacks on port, queueing job ids on job_ids"""
+    server = BaseHTTPServer.HTTPServer(('', port), CallbackHandler)
+    server.job_ids = job_ids
+    server.verbose = verbose
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,263 @@
+"""
+Streaming readers and atomic, streaming writers for PO and JSON catalogs,
+and their compiled forms: .mo files and minified JSON.
+
+Catalogs are written entry by entry, to a temporary file that is renamed
+over the original. If the new catalog is byte-identical to the old one, the
+original file is left alone, mtime and all.
+"""
+
+import codecs
+import json
+import os
+import re
+import tempfile
+
+
+class AtomicFile(object):
+    """
+    A binary file, written to a temporary file next to filename, and
+    renamed over it on commit(), unless the contents haven't changed.
+    Used as a context manager, commits on success and aborts on errors.
+    """
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Whether the original file has matched everything written so far
+        try:
+            self._old = open(filename, 'rb')
+            self.identical = True
+        except IOError:
+            self._old = None
+            self.identical = False
+        self.changed = None
+        self._buffer = []
+        self._buffered = 0
+        dirname, basename = os.path.split(filename)
+        fd, self._tmp = tempfile.mkstemp(prefix='.%s.' % basename,
+                                         suffix='.tmp', dir=dirname or '.')
+        self._new = os.fdopen(fd, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.abort()
+        else:
+            self.commit()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self.identical and self._old.read(len(data)) != data:
+            self.identical = False
+        self._new.write(data)
+
+    def _close(self):
+        self._new.close()
+        if self._old:
+            self._old.close()
+
+    def commit(self):
+        """Replace the file, if it changed. Return whether it did"""
+        self._flush()
+        if self.identical and self._old.read(1):
+            self.identical = False
+        self.changed = not self.identical
+        self._close()
+        if self.changed:
+            os.chmod(self._tmp, file_mode(self.filename))
+            os.rename(self._tmp, self.filename)
+        else:
+            os.unlink(self._tmp)
+        return self.changed
+
+    def abort(self):
+        """Leave the file as it was"""
+        self._close()
+        os.unlink(self._tmp)
+
+
+def file_mode(filename):
+    """The permissions of filename, or the ones a new file would get"""
+    try:
+        return os.stat(filename).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_po(po, filename=None):
+    """
+    Write a polib.POFile, one entry at a time, to filename (default: the
+    file it was read from). Return whether the file changed.
+    The output is identical to POFile.save()'s.
+    """
+    encoding = po.encoding
+    with AtomicFile(filename or po.fpath) as f:
+        for line in po.header.split('\n'):
+            if line[:1] in (',', ':'):
+                f.write(('#%s\n' % line).encode(encoding))
+            else:
+                f.write(('# %s\n' % line).encode(encoding))
+        f.write(po.metadata_as_entry().__unicode__(po.wrapwidth)
+                .encode(encoding))
+        for entry in po:
+            if not entry.obsolete:
+                f.write(b'\n' + entry.__unicode__(po.wrapwidth)
+                        .encode(encoding))
+        for entry in po.obsolete_entries():
+            f.write(b'\n' + entry.__unicode__(po.wrapwidth).encode(encoding))
+    return f.changed
+
+
+def write_mo(po, filename):
+    """
+    Compile a polib.POFile to a .mo file, leaving out fuzzy and untranslated
+    entries, like msgfmt. Return whether the file changed.
+    """
+    with AtomicFile(filename) as f:
+        f.write(po.to_binary())
+    return f.changed
+
+
+def write_json(filename, data, minify=False):
+    """
+    Write a JSON catalog (a {message: translation} dict) to filename,
+    one chunk at a time, indented unless minify. Return whether the file
+    changed.
+    """
+    if minify:
+        encoder = json.JSONEncoder(sort_keys=True, ensure_ascii=False,
+                                   separators=(',', ':'))
+    else:
+        encoder = json.JSONEncoder(
+            sort_keys=True,
+            indent=2,
+            ensure_ascii=False,
+            separators=(',', ': '),  # removes trailing space
+        )
+    with AtomicFile(filename) as f:
+        for chunk in encoder.iterencode(data):
+            f.write(unicode(chunk).encode('utf-8'))
+    return f.changed
+
+
+class ScanEntry(object):
+    """The parts of a PO entry that a scan needs"""
+    __slots__ = ('msgctxt', 'msgid', 'msgid_plural', 'msgstr', 'flags',
+                 'obsolete')
+
+    def __init__(self):
+        self.msgctxt = None
+        self.msgid = u''
+        self.msgid_plural = u''
+        self.msgstr = u''
+        self.flags = []
+        self.obsolete = False
+
+
+_charset = re.compile(r'Content-Type:.+? charset=([\w_\-:\.]+)')
+
+
+def _header_encoding(line, encoding):
+    """
+    The encoding that a header line's Content-Type names, or encoding if
+    there's none. Like polib, fall back to UTF-8 if Python doesn't know it,
+    e.g. the template's placeholder, CHARSET.
+    """
+    match = _charset.search(line)
+    if not match:
+        return encoding
+    try:
+        codecs.lookup(match.group(1))
+    except LookupError:
+        return 'utf-8'
+    return match.group(1)
+
+
+def _string(line, encoding):
+    """The unescaped contents of a quoted PO string"""
+    value = line[line.index(b'"') + 1:line.rindex(b'"')].decode(encoding)
+    if u'\\' in value:
+        import polib
+        value = polib.unescape(value)
+    return value
+
+
+def scan_po(filename):
+    """
+    Yield a ScanEntry for every entry in a PO file, but the header.
+    Much cheaper than polib.pofile(): comments, occurrences, previous
+    msgids and plural translations are skipped, not parsed. The entries
+    come in the same order as polib's.
+    """
+    encoding = 'utf-8'
+    entry = ScanEntry()
+    # The field that continuation lines are added to
+    field = None
+    # Whether entry has a msgstr, so the next msgctxt, msgid or comment
+    # starts a new one
+    complete = False
+    header = True
+    with open(filename, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            obsolete = line.startswith(b'#~')
+            if obsolete:
+                line = line[2:].lstrip()
+            if not line:
+                continue
+
+            if line.startswith(b'"'):
+                if field:
+                    setattr(entry, field,
+                            getattr(entry, field) + _string(line, encoding))
+                    if header and field == 'msgstr':
+                        encoding = _header_encoding(line, encoding)
+                continue
+
+            keyword = line.split(None, 1)[0]
+            if complete and (line.startswith(b'#') or
+                             keyword in (b'msgctxt', b'msgid')):
+                if header and not entry.obsolete and entry.msgid == u'':
+                    header = False
+                else:
+                    yield entry
+                entry = ScanEntry()
+                complete = False
+
+            field = None
+            if line.startswith(b'#,'):
+                flags = line[2:].decode(encoding).split(u',')
+                entry.flags += [flag.strip() for flag in flags if flag.strip()]
+            elif line.startswith(b'#'):
+                pass
+            elif keyword in (b'msgctxt', b'msgid', b'msgid_plural',
+                             b'msgstr'):
+                field = keyword
+                value = _string(line, encoding)
+                if keyword == b'msgctxt':
+                    entry.msgctxt = value
+                else:
+                    setattr(entry, field, value)
+                entry.obsolete = obsolete
+                if header and keyword == b'msgstr':
+                    encoding = _header_encoding(line, encoding)
+                complete = complete or keyword == b'msgstr'
+            elif keyword.startswith(b'msgstr['):
+                complete = True
+    if complete and not (header and not entry.obsolete and
+                         entry.msgid == u''):
+        yield entry
@@ -3,28 +3,72 @@
 """Gengo gettext."""
 
 import argparse
-import cgi
+import collections
 import ConfigParser
-import io
+import contextlib
+import errno
+import hashlib
 import itertools
 import json
 import os
+import Queue
+import random
 import re
+import socket
+import sqlite3
 import sys
+import threading
 import time
-from decimal import Decimal
 
-from gengo import Gengo, GengoError
-import polib
-from yoconfigurator.base import read_config
+# gengo, requests, polib, yoconfigurator, multiprocessing and a few more
+# are imported where they're used, so that commands that don't need them
+# (scan) start quickly
 
 import orm
-from orm import Job, Order
+from cache import CachingClient, ResponseCache
+from catalogs import scan_po, write_json, write_mo, write_po
+from metrics import METRICS, InstrumentedClient
+from orm import Catalog, Job, Lease, Order, Outbox, Review, Unconfirmed
+from tm import TranslationMemory
 
 
 DEBUG = False
 MAX_COST = 100
 COMMENT = ''
+# Maximum simultaneous Gengo API requests, and requests per second (0: no
+# limit)
+CONCURRENCY = 8
+RATE_LIMIT = 0
+# Parse every catalog, even if it hasn't changed since the last run
+FULL_SCAN = False
+# The most jobs getTranslationJobs will return
+JOB_PAGE_SIZE = 200
+# Seconds to wait for Gengo to queue a new order's jobs, before leaving it
+# for the next run, and the longest interval between polls
+ORDER_TIMEOUT = 600
+MAX_POLL_INTERVAL = 30
+# Jobs per quote / order request, and attempts at posting each order
+BATCH_SIZE = 500
+POST_ATTEMPTS = 3
+# Queue reviews and apply earlier decisions, without prompting for new ones
+QUEUE_REVIEWS = False
+# Seconds to wait for more callbacks, after one arrives, in watch mode
+CALLBACK_DELAY = 1
+# Seconds to wait before retrying after an API error, in watch mode. It
+# doubles with every error in a row, up to the poll interval.
+RETRY_DELAY = 10
+# On-disk cache for API responses that don't change, or None
+RESPONSE_CACHE = None
+# Similarity threshold for translation memory suggestions (1: only
+# whitespace and case may differ), or None to always order jobs
+TRANSLATION_MEMORY = None
+# Compile catalogs to .mo files and minified JSON, next to them
+COMPILE = False
+# Seconds that a --shared run may hold a unit of work, before another run
+# can take it over
+LEASE_TTL = 900
+# The leases that another run took over while this one held them
+LOST_LEASES = set()
 LANGMAP = {
     # Our language to Gengo language + explanatory comment
     'nb': ('no', u'Norwegian Bokmål'),
@@ -37,21 +81,79 @@ _gengo = None
 def gengo():
     global _gengo
     if not _gengo:
+        from gengo import Gengo
+        from yoconfigurator.base import read_config
+
         PROJECT_ROOT = os.path.dirname(os.path.realpath(__file__))
         config = read_config(PROJECT_ROOT)['gengo-gettext']
-        _gengo = Gengo(
+        # Metrics only see the calls that the cache doesn't answer
+        _gengo = InstrumentedClient(Gengo(
             public_key=str(config.gengo.public_key),
             private_key=str(config.gengo.private_key),
             sandbox=config.gengo.sandbox,
-        )
+        ), METRICS)
+        if RESPONSE_CACHE:
+            _gengo = CachingClient(_gengo, ResponseCache(RESPONSE_CACHE))
     return _gengo
 
 
+class RateLimiter(object):
+    """Space out calls to wait(), across threads, to rate per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def api_map(func, iterable):
+    """
+    Call func on every item in iterable, in a pool of CONCURRENCY threads,
+    at no more than RATE_LIMIT calls per second.
+    Yield the results, in order.
+    """
+    items = list(iterable)
+    if not items:
+        return
+    # Create the client before any of the threads need it
+    gengo()
+    rate_limiter = RateLimiter(RATE_LIMIT)
+
+    def call(item):
+        rate_limiter.wait()
+        return func(item)
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(CONCURRENCY, len(items)))
+    try:
+        for result in pool.imap(call, items):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def po_file(locale_dir, lang, domain):
     """Return po path."""
     return os.path.join(locale_dir, lang, 'LC_MESSAGES', '%s.po' % domain)
 
 
+def json_file(locale_dir, lang):
+    """Return JSON catalog path."""
+    return os.path.join(locale_dir, '{}.json'.format(lang))
+
+
 def locale_to_gengo_language(locale):
     """
     Return the Gengo language code, and an explanatory comment for a Unix
@@ -68,17 +170,38 @@ def gengo_language_to_locale(lang):
     return parts[0] + parts[1].replace('-', '_') + parts[2].upper()
 
 
-def check_entry(lang, entry, edit_jobs):
+def get_job_index(job_indexes, lang):
+    """Return the known jobs for lang, loading them on first use"""
+    if lang not in job_indexes:
+        job_indexes[lang] = Job.get_index(lang)
+    return job_indexes[lang]
+
+
+def get_memory(memories, lang, known_jobs):
+    """
+    Return the translation memory for lang, building it from known_jobs on
+    first use. None if TRANSLATION_MEMORY is disabled.
+    """
+    if TRANSLATION_MEMORY is None:
+        return None
+    if lang not in memories:
+        memories[lang] = TranslationMemory.from_jobs(known_jobs.itervalues(),
+                                                     TRANSLATION_MEMORY)
+    return memories[lang]
+
+
+def check_entry(lang, entry, edit_jobs, known_jobs, memory=None):
     """
-    Check a POEntry. Return a job if one needs to be created.
-    Update if there's a translation in our DB
+    Check a POEntry or ScanEntry. Return a job if one needs to be created.
+    Update if there's a translation in our DB (known_jobs). Otherwise, fill
+    in a fuzzy suggestion from memory, if it has one.
     """
     # Translated
     if entry.msgstr and 'fuzzy' not in entry.flags:
         return 'ok', None
 
     # Translation in progress
-    job = Job.find(lang, entry.msgid)
+    job = known_jobs.get(entry.msgid)
     if job:
         if job.status == 'approved':
             entry.msgstr = job.translation
@@ -87,14 +210,22 @@ def check_entry(lang, entry, edit_jobs):
             return 'updated', None
         return 'waiting', None
 
-    job = get_job_data(entry.msgid, lang, edit_jobs)
-    if entry.msgstr:
-        job['comment'] += ('\nFuzzy translation. Previous translation was:\n' +
-                           entry.msgstr)
+    suggestion = None
+    if memory is not None:
+        suggestion = memory.lookup(entry.msgid)
+    if suggestion:
+        if entry.msgstr == suggestion and 'fuzzy' in entry.flags:
+            return 'ok', None
+        entry.msgstr = suggestion
+        if 'fuzzy' not in entry.flags:
+            entry.flags.append('fuzzy')
+        return 'suggested', None
+
+    job = get_job_data(entry.msgid, lang, edit_jobs, entry.msgstr)
     return 'job', job
 
 
-def get_job_data(message, target_language, edit_jobs):
+def get_job_data(message, target_language, edit_jobs, previous=None):
     job = {
         'body_src': message,
         'comment': COMMENT,
@@ -109,73 +240,255 @@ def get_job_data(message, target_language, edit_jobs):
     job['lc_tgt'], comment = locale_to_gengo_language(job['lc_tgt'])
     if comment:
         job['comment'] += u'\n' + comment
+    if previous:
+        job['comment'] += ('\nFuzzy translation. Previous translation was:\n' +
+                           previous)
     return job
 
 
-def walk_po_file(locale_dir, lang, domain, edit_jobs):
-    """Walk through a po file and yield any jobs that need to be submitted"""
+def stat_files(filenames):
+    """Return the latest mtime and total size of filenames"""
+    stats = [os.stat(filename) for filename in filenames]
+    return (max(stat.st_mtime for stat in stats),
+            sum(stat.st_size for stat in stats))
+
+
+def hash_files(filenames):
+    h = hashlib.sha1()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+def load_catalog(path, catalogs):
+    """
+    Return the Catalog for path, from catalogs ({path: Catalog}), or the DB
+    if catalogs is None
+    """
+    if catalogs is None:
+        return Catalog.get_where('path = ?', (path,))
+    return catalogs.get(path)
+
+
+def store_catalog(catalog, catalogs):
+    """Store catalog in catalogs, or the DB if catalogs is None"""
+    if catalogs is None:
+        catalog.save()
+    else:
+        catalogs[catalog.path] = catalog
+
+
+def record_catalog(path, filenames, pending, catalogs=None):
+    """
+    Remember the state of the files making up a catalog, and the messages
+    in it that are waiting for a translation
+    """
+    mtime, size = stat_files(filenames)
+    store_catalog(Catalog(path=path, mtime=mtime, size=size,
+                          hash=hash_files(filenames),
+                          pending=json.dumps(pending)),
+                  catalogs)
+
+
+def unchanged_catalog_pending(path, filenames, known_jobs, catalogs=None):
+    """
+    If a catalog's files haven't changed since record_catalog, and none of
+    its pending messages have been approved since, return the pending
+    messages, as (message, previous translation) pairs.
+    Otherwise, return None: the catalog needs to be walked.
+    """
+    if FULL_SCAN:
+        return None
+    catalog = load_catalog(path, catalogs)
+    if not catalog:
+        return None
+    mtime, size = stat_files(filenames)
+    if (mtime, size) != (catalog.mtime, catalog.size):
+        if size != catalog.size or hash_files(filenames) != catalog.hash:
+            return None
+        # Touched, but identical
+        catalog.mtime = mtime
+        store_catalog(catalog, catalogs)
+    pending = json.loads(catalog.pending)
+    for message, previous in pending:
+        job = known_jobs.get(message)
+        if job and job.status == 'approved':
+            return None
+    return pending
+
+
+def walk_pending(pending, lang, edit_jobs, known_jobs):
+    """Yield jobs for pending messages that haven't been ordered, yet"""
+    for message, previous in pending:
+        if message not in known_jobs:
+            yield get_job_data(message, lang, edit_jobs, previous)
+
+
+def walk_po_file(locale_dir, lang, domain, edit_jobs, known_jobs=None,
+                 catalogs=None, memory=None):
+    """
+    Walk through a po file and yield any jobs that need to be submitted.
+    Messages that memory (a TranslationMemory) has a translation for get
+    it as a fuzzy suggestion, instead. Its other translations go into
+    memory.
+    """
     filename = po_file(locale_dir, lang, domain)
     if DEBUG:
         print 'Processing %s' % filename
     if not os.path.exists(filename):
         print 'Missing PO file: %s' % filename
         return
-    po = polib.pofile(filename)
-    updated = False
+    if known_jobs is None:
+        known_jobs = Job.get_index(lang)
     print 'Creating jobs for {} locale'.format(lang),
     sys.stdout.flush()
-    for entry in po:
+
+    pending = unchanged_catalog_pending(filename, [filename], known_jobs,
+                                        catalogs)
+    if memory is not None and pending:
+        # Walk it again if there's a new suggestion for a pending message
+        if any(memory.lookup(message) for message, previous in pending):
+            pending = None
+    if pending is not None:
+        if DEBUG:
+            print '(unchanged)',
+        for job in walk_pending(pending, lang, edit_jobs, known_jobs):
+            yield job
+            sys.stdout.write('.')
+            sys.stdout.flush()
+        if COMPILE:
+            compile_po_file(filename)
+        print
+        return
+
+    # Scan the file cheaply, and only parse it with polib to save changes
+    changes = {}
+    pending = []
+    for entry in scan_po(filename):
         if entry.obsolete:
             continue
-        action, job = check_entry(lang, entry, edit_jobs)
+        action, job = check_entry(lang, entry, edit_jobs, known_jobs,
+                                  memory)
         if job:
             yield job
-        if action == 'updated':
-            updated = True
+        if action in ('updated', 'suggested'):
+            changes[entry.msgctxt, entry.msgid] = entry
+        if (action == 'ok' and memory is not None
+                and 'fuzzy' not in entry.flags):
+            memory.add(entry.msgid, entry.msgstr)
+        if action in ('job', 'waiting'):
+            pending.append((entry.msgid, entry.msgstr))
         if action == 'job':
             sys.stdout.write('.')
             sys.stdout.flush()
-    if updated:
-        print '\nSaving approved messages'
-        po.save()
+    po = None
+    if changes:
+        print '\nSaving approved and suggested messages'
+        import polib
+        po = polib.pofile(filename)
+        for entry in po:
+            change = changes.get((entry.msgctxt, entry.msgid))
+            if change and not entry.obsolete:
+                entry.msgstr = change.msgstr
+                entry.flags = change.flags
+        write_po(po)
+    if COMPILE:
+        compile_po_file(filename, po)
+    record_catalog(filename, [filename], pending, catalogs)
     print
 
 
+def is_stale(source, artifact):
+    """Whether artifact is missing, or older than source"""
+    try:
+        return os.stat(artifact).st_mtime < os.stat(source).st_mtime
+    except OSError:
+        return True
+
+
+def compile_po_file(filename, po=None):
+    """
+    Compile a PO catalog (parsed as po, if given) to a .mo file next to it,
+    unless the .mo file is up to date.
+    """
+    mo_filename = os.path.splitext(filename)[0] + '.mo'
+    if not is_stale(filename, mo_filename):
+        return
+    if po is None:
+        import polib
+        po = polib.pofile(filename)
+    if DEBUG:
+        print 'Compiling %s' % mo_filename
+    if not write_mo(po, mo_filename):
+        # Identical, but older than the catalog: don't compile it again
+        os.utime(mo_filename, None)
+
+
+def compile_json_file(filename, translations=None):
+    """
+    Minify a JSON catalog (loaded as translations, if given) to a .min.json
+    file next to it, unless that is up to date.
+    """
+    min_filename = os.path.splitext(filename)[0] + '.min.json'
+    if not is_stale(filename, min_filename):
+        return
+    if translations is None:
+        with open(filename) as f:
+            translations = json.load(f)
+    if DEBUG:
+        print 'Compiling %s' % min_filename
+    if not write_json(min_filename, translations, minify=True):
+        os.utime(min_filename, None)
+
+
 def quote_jobs(jobs):
-    job_dict = dict(enumerate(jobs))
-    r = gengo().determineTranslationCost(jobs=job_dict)
+    from decimal import Decimal
+
+    def quote(batch):
+        return gengo().determineTranslationCost(jobs=dict(enumerate(batch)))
+
     currency = None
     credits = 0
-    for job in r['response']['jobs']:
-        currency = job['currency']
-        credits += Decimal(job['credits'])
+    for r in api_map(quote, chunked(jobs, BATCH_SIZE)):
+        for job in r['response']['jobs']:
+            currency = job['currency']
+            credits += Decimal(job['credits'])
     print 'Cost: %s %0.2f' % (currency, credits)
     return credits
 
 
-def post_jobs(jobs):
-    print 'Posting Jobs...'
-    ctime = time.time()
-
-    r = gengo().postTranslationJobs(jobs=jobs)
-    order_id = r['response']['order_id']
-
-    Order(id=order_id, created=ctime).save()
-
-    if DEBUG:
-        print 'Waiting for the jobs to be available in the API...'
+def wait_for_order(order_id, timeout):
+    """
+    Poll an order until Gengo has finished queueing its jobs, backing off
+    exponentially (with jitter) between requests.
+    Return the order, or None if it still isn't ready after timeout seconds.
+    """
+    deadline = time.time() + timeout
+    delay = 1
     while True:
         r = gengo().getTranslationOrderJobs(id=order_id)
-        if int(r['response']['order']['jobs_queued']) == 0:
-            break
-        time.sleep(1)
-
+        order = r['response']['order']
+        queued = int(order['jobs_queued'])
+        if queued == 0:
+            return order
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        print 'Order %s: %i of %s jobs still queued' % (
+            order_id, queued, order.get('total_jobs', '?'))
+        time.sleep(min(remaining, delay * random.uniform(0.5, 1.5)))
+        delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+
+def save_order_jobs(order_id, order):
     jobs_to_be_saved = (
-        r['response']['order']['jobs_available'] +
+        order['jobs_available'] +
         # messages translated in the scope of older orders
-        r['response']['order']['jobs_approved']
+        order['jobs_approved']
     )
-    for job in jobs_to_be_saved:
+    Job.save_many(
         Job(
             id=job,
             order_id=order_id,
@@ -183,47 +496,246 @@ def post_jobs(jobs):
             source=None,
             translation=None,
             status='queued'
-        ).save()
+        ) for job in jobs_to_be_saved)
+    # Even if it had none of those, so resume_orders stops checking on it
+    Order.resolve(order_id)
+
+
+def post_order(jobs):
+    """Post an order. Return its id and None, or None and the error"""
+    from gengo import GengoError
+    import requests
+
+    try:
+        r = gengo().postTranslationJobs(jobs=jobs)
+    except (GengoError, requests.RequestException) as e:
+        return None, e
+    return r['response']['order_id'], None
+
+
+# Socket errors that mean we never connected
+CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def order_not_created(error):
+    """
+    Whether a post_order error proves that Gengo didn't create the order:
+    an error response, or a failure to connect. Anything else (a timeout,
+    or a connection reset while waiting for the response) is ambiguous.
+    """
+    from gengo import GengoError
+    import requests
+
+    if isinstance(error, GengoError):
+        return True
+    connect_timeout = getattr(requests.exceptions, 'ConnectTimeout', None)
+    if connect_timeout and isinstance(error, connect_timeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    # requests wraps urllib3's MaxRetryError, or the socket error itself
+    cause = getattr(error.args[0], 'reason', error.args[0])
+    if type(cause).__name__ in ('NewConnectionError', 'ConnectTimeoutError'):
+        return True
+    if isinstance(cause, socket.gaierror):
+        return True
+    return isinstance(cause, socket.error) and cause.errno in CONNECT_ERRNOS
+
+
+def post_jobs(jobs, posted=None):
+    """
+    Post jobs, in batches. Return the ones that certainly weren't posted.
+    If given, posted is called with each batch that was, or may have been,
+    ordered, as soon as we know.
+    Batches that failed ambiguously aren't retried or returned. They're
+    saved as Unconfirmed, and not ordered again until confirm_posts finds
+    their order, or shows that Gengo didn't create one.
+    """
+    print 'Posting Jobs...'
+    ctime = time.time()
+
+    def post(batch):
+        # Another run may be ordering them, now
+        if 'order' in LOST_LEASES:
+            return None, None
+        return post_order(batch)
+
+    # One order per batch. Retry the batches that certainly failed.
+    batches = chunked(jobs, BATCH_SIZE)
+    order_ids = []
+    lost = []
+    for attempt in range(POST_ATTEMPTS):
+        failed = []
+        for batch, (order_id, error) in itertools.izip(
+                batches, api_map(post, batches)):
+            if order_id is None and error is None:
+                lost.append(batch)
+            elif not error:
+                Order(id=order_id, created=ctime).save()
+                order_ids.append(order_id)
+                if posted:
+                    posted(batch)
+            elif order_not_created(error):
+                print 'Failed to post %i jobs: %s' % (len(batch), error)
+                failed.append(batch)
+            else:
+                print ('Posting %i jobs failed, but Gengo may have ordered '
+                       "them anyway: %s. They won't be ordered again until "
+                       'a sync shows whether it did.' % (len(batch), error))
+                Unconfirmed.save_many(
+                    Unconfirmed(key=json.dumps(job_key(job)),
+                                job=json.dumps(job), created=ctime)
+                    for job in batch)
+                if posted:
+                    posted(batch)
+        batches = failed
+        if not batches:
+            break
+    if batches:
+        print ('Gave up on posting %i jobs. They will be ordered on the next '
+               'run.' % sum(len(batch) for batch in batches))
+    if lost:
+        print ('Not posting %i jobs: another run took over the order lease'
+               % sum(len(batch) for batch in lost))
+    unposted = [job for batch in lost + batches for job in batch]
+
+    if DEBUG:
+        print 'Waiting for the jobs to be available in the API...'
+    orders = api_map(lambda order_id: wait_for_order(order_id, ORDER_TIMEOUT),
+                     order_ids)
+    for order_id, order in itertools.izip(order_ids, orders):
+        if order is None:
+            print ('Order %s is still being processed. '
+                   'It will be picked up on the next run.' % order_id)
+        else:
+            save_order_jobs(order_id, order)
 
     update_statuses()
+    return unposted
 
 
-def update_db():
-    print 'Updating known orders...'
-    latest_order = Order.get_latest()
-    if not latest_order:
-        r = gengo().getTranslationJobs(count=200)
-    else:
-        # This is actually the latest 200 after N, which is a bit useless
-        r = gengo().getTranslationJobs(timestamp_after=latest_order.created,
-                                       count=200)
+def resume_orders():
+    """
+    Check on any orders that post_jobs gave up waiting for.
+    Return True if there are none left.
+    """
+    done = True
+    for pending in list(Order.get_pending()):
+        print 'Checking on order %s...' % pending.id
+        order = wait_for_order(pending.id, 0)
+        if order is None:
+            done = False
+        else:
+            save_order_jobs(pending.id, order)
+    return done
 
-    job_ids = [job['job_id'] for job in r['response']]
-    if not job_ids:
-        return
-    r = gengo().getTranslationJobBatch(id=','.join(job for job in job_ids))
+
+def confirm_posts():
+    """
+    Settle the posts that failed ambiguously, in post_jobs. Forget their
+    jobs once the DB has an order with them, or once a complete listing of
+    the jobs submitted since shows that Gengo didn't create one.
+    Return True if none are left unsettled.
+    """
+    unconfirmed = list(Unconfirmed.get_all_where('1 ORDER BY created'))
+    if not unconfirmed:
+        return True
+    print 'Checking on %i jobs from failed posts...' % len(unconfirmed)
+    job_ids = get_recent_job_ids(unconfirmed[0].created)
+    complete = len(job_ids) < JOB_PAGE_SIZE
+    fetch_jobs(job_ids)
+    settled = 0
+    for entry in unconfirmed:
+        job = json.loads(entry.job)
+        if complete or Job.find(gengo_language_to_locale(job['lc_tgt']),
+                                job['body_src']):
+            Unconfirmed.delete_where('key = ?', (entry.key,))
+            settled += 1
+    if settled < len(unconfirmed):
+        print ("WARNING: %i jobs from failed posts won't be ordered until "
+               'Gengo lists few enough jobs to show whether it ordered them.'
+               % (len(unconfirmed) - settled))
+    return settled == len(unconfirmed)
+
+
+# The lists of job ids in a getTranslationOrderJobs response
+ORDER_JOB_LISTS = ('jobs_available', 'jobs_pending', 'jobs_reviewable',
+                   'jobs_approved', 'jobs_revising', 'jobs_cancelled',
+                   'jobs_held')
+
+
+def get_recent_job_ids(timestamp_after=None):
+    """
+    Return the ids of the jobs submitted after timestamp_after.
+
+    getTranslationJobs only returns the newest JOB_PAGE_SIZE of them, and
+    can't page back to older ones. If a page comes back full, we warn:
+    update_db fills in the rest of the listed jobs' orders, but orders with
+    no listed jobs are missing.
+    """
+    kwargs = {'count': JOB_PAGE_SIZE}
+    if timestamp_after is not None:
+        kwargs['timestamp_after'] = timestamp_after
+    response = gengo().getTranslationJobs(**kwargs)['response']
+    if len(response) >= JOB_PAGE_SIZE:
+        print ('WARNING: Gengo only lists the newest %i jobs submitted '
+               'after %s. The rest of their orders will be fetched, but '
+               'jobs from older orders may be missing from the DB.'
+               % (JOB_PAGE_SIZE, timestamp_after))
+    return set(int(job['job_id']) for job in response)
+
+
+def get_order_job_ids(order_id):
+    """Return the ids of every job in an order"""
+    order = gengo().getTranslationOrderJobs(id=order_id)['response']['order']
+    return set(int(job_id) for key in ORDER_JOB_LISTS
+               for job_id in order.get(key, ()))
+
+
+def fetch_jobs(job_ids):
+    """
+    Fetch the jobs in job_ids that aren't in the DB, and save them, with
+    their orders. Return the ids of those orders.
+    """
+    job_ids = sorted(set(job_ids) - Job.get_known_ids(job_ids))
+
+    def fetch(batch):
+        return gengo().getTranslationJobBatch(
+            id=','.join(str(id) for id in batch))
 
     orders = {}
-    for job_data in r['response']['jobs']:
-        if job_data['status'] == 'deleted':
-            continue
-        if Job.get_where('id = ?', (job_data['job_id'],)):
-            continue
-        lang = gengo_language_to_locale(job_data['lc_tgt'])
-        job = Job(
-            id=job_data['job_id'],
-            order_id=job_data['order_id'],
-            lang=lang,
-            source=job_data['body_src'],
-            translation=job_data.get('body_tgt', ''),
-            status=job_data['status'],
-        )
-        job.save()
-        orders[job_data['order_id']] = job_data['ctime']
+    for r in api_map(fetch, chunked(job_ids, 100)):
+        jobs = []
+        for job_data in r['response']['jobs']:
+            if job_data['status'] == 'deleted':
+                continue
+            lang = gengo_language_to_locale(job_data['lc_tgt'])
+            jobs.append(Job(
+                id=job_data['job_id'],
+                order_id=job_data['order_id'],
+                lang=lang,
+                source=job_data['body_src'],
+                translation=job_data.get('body_tgt', ''),
+                status=job_data['status'],
+            ))
+            orders[int(job_data['order_id'])] = job_data['ctime']
+        Job.save_many(jobs)
+    Order.save_many(Order(id=order_id, created=ctime)
+                    for order_id, ctime in orders.iteritems())
+    return set(orders)
+
+
+def update_db():
+    print 'Updating known orders...'
+    latest_order = Order.get_latest()
+    timestamp_after = latest_order.created if latest_order else None
 
-    for order_id, ctime in orders.iteritems():
-        order = Order(id=order_id, created=ctime)
-        order.save()
+    order_ids = fetch_jobs(get_recent_job_ids(timestamp_after))
+    # The jobs of the same orders that were too old to be listed
+    job_ids = set()
+    for order_job_ids in api_map(get_order_job_ids, sorted(order_ids)):
+        job_ids.update(order_job_ids)
+    fetch_jobs(job_ids)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -233,15 +745,30 @@ def grouper(iterable, n, fillvalue=None):
     return itertools.izip_longest(fillvalue=fillvalue, *args)
 
 
-def update_statuses():
-    print 'Updating state of in-progress jobs...'
-    for batch in grouper(Job.get_in_progress(), 100):
-        jobs = {}
-        for job in batch:
-            if job:
-                jobs[job.id] = job
+def chunked(items, n):
+    """Split the list items into lists of up to n items"""
+    return [items[i:i + n] for i in range(0, len(items), n)]
+
 
-        r = gengo().getTranslationJobBatch(id=','.join(str(id) for id in jobs))
+def update_statuses(job_ids=None, lang=None):
+    """
+    Update the in-progress jobs (only the ones in job_ids, and in lang, if
+    given) from the API. Return the ones that have been approved.
+    """
+    print 'Updating state of in-progress jobs...'
+    in_progress = [job for job in Job.get_in_progress()
+                   if (job_ids is None or job.id in job_ids) and
+                   (lang is None or job.lang == lang)]
+    batches = [dict((job.id, job) for job in batch if job)
+               for batch in grouper(in_progress, 100)]
+
+    def fetch(jobs):
+        return gengo().getTranslationJobBatch(
+            id=','.join(str(id) for id in jobs))
+
+    # The requests run concurrently, but we update the DB from this thread
+    approved = []
+    for jobs, r in itertools.izip(batches, api_map(fetch, batches)):
         for job_data in r['response']['jobs']:
             job = jobs[int(job_data['job_id'])]
             job.status = job_data['status']
@@ -249,37 +776,44 @@ def update_statuses():
             job.translation = job_data.get('body_tgt', '')
             job.lang = gengo_language_to_locale(job_data['lc_tgt'])
             fix_translation(job)
-            job.save()
+            if job.status == 'approved':
+                approved.append(job)
+        Job.save_many(jobs.itervalues())
+    return approved
+
+
+# Checks for check_translation, as (compiled regex, message) pairs
+CHECKS = []
+# Matches anything that any of the CHECKS match
+_any_check = re.compile('(?!)')
+
+
+def register_check(regex, message):
+    """
+    Add a check to check_translation: Any matches for regex in the source
+    must be present, identically, in the translation.
+    message may refer to %(first_missing)s.
+    """
+    global _any_check
+    CHECKS.append((re.compile(regex), message))
+    _any_check = re.compile('|'.join('(?:%s)' % check.pattern
+                                     for check, message in CHECKS))
 
 
 def check_translation(job):
     if not job.translation.strip():
         return 'empty translation'
 
+    # Most strings have nothing for any of the checks to find.
+    # If _any_check finds nothing in either, none of the CHECKS will.
+    if (not _any_check.search(job.source)
+            and not _any_check.search(job.translation)):
+        return None
+
     problems = []
-    # Check that some strings, if present in the source, are present,
-    # identically, in the translation
-    for regex, message in (
-        (r'<.*?>', 'HTML tags'),
-        (r'%(?:\(\w+\))?[#0 +-]?(?:[0-9*]+\$?)?\.?(?:[0-9]+\$?)?'
-         r'[diouxXeEfFgGcrs]',
-         '%(first_missing)s is a substitution. '
-         'It will be replaced with something, '
-         'when the program displays this message. So, it must appear, '
-         'verbatim, in the translation, where you want the same substitution '
-         'to happen.'),
-        (r'{[a-z0-9_]*(?:![rs])?'
-         r'(?::(?:.?[<>=^])?[ +-]?#?0?[0-9]*,?(?:\.[0-9]+)?'
-         r'[bcdeEfFgGnosxX%]?)?}', 'Python format string'),
-        (r'%%', 'Escaped percent symbol'),
-        (r'&[a-z]+;',
-         '%(first_missing)s is a an HTML entity (i.e. a special symbol, or '
-         'punctuation) See: https://en.wikipedia.org/wiki/HTML_Entity '),
-        (r'##.*?##', 'Yola site template substitution'),
-        (r'\{\{.*?\}\}', 'Handlebars substitution'),
-    ):
-        source_matches = set(re.findall(regex, job.source))
-        translation_matches = set(re.findall(regex, job.translation))
+    for regex, message in CHECKS:
+        source_matches = set(regex.findall(job.source))
+        translation_matches = set(regex.findall(job.translation))
         if source_matches != translation_matches:
             missing = source_matches - translation_matches
             problems.append(message % {
@@ -292,6 +826,30 @@ def check_translation(job):
             % ', '.join(problems))
 
 
+# Check that some strings, if present in the source, are present,
+# identically, in the translation
+register_check(r'<.*?>', 'HTML tags')
+register_check(
+    r'%(?:\(\w+\))?[#0 +-]?(?:[0-9*]+\$?)?\.?(?:[0-9]+\$?)?'
+    r'[diouxXeEfFgGcrs]',
+    '%(first_missing)s is a substitution. '
+    'It will be replaced with something, '
+    'when the program displays this message. So, it must appear, '
+    'verbatim, in the translation, where you want the same substitution '
+    'to happen.')
+register_check(
+    r'{[a-z0-9_]*(?:![rs])?'
+    r'(?::(?:.?[<>=^])?[ +-]?#?0?[0-9]*,?(?:\.[0-9]+)?'
+    r'[bcdeEfFgGnosxX%]?)?}', 'Python format string')
+register_check(r'%%', 'Escaped percent symbol')
+register_check(
+    r'&[a-z]+;',
+    '%(first_missing)s is a an HTML entity (i.e. a special symbol, or '
+    'punctuation) See: https://en.wikipedia.org/wiki/HTML_Entity ')
+register_check(r'##.*?##', 'Yola site template substitution')
+register_check(r'\{\{.*?\}\}', 'Handlebars substitution')
+
+
 def fix_translation(job):
     # Auto-whitespace
     m = re.match(r'^(\s*).*?(\s*)$', job.source, re.DOTALL)
@@ -303,16 +861,103 @@ def fix_translation(job):
 
 
 def review():
-    for job in list(Job.get_reviewable()):
+    """
+    Queue reviewable jobs, let the reviewer decide on the queue offline,
+    then apply all the decisions at once
+    """
+    jobs = queue_reviews()
+    if not QUEUE_REVIEWS:
+        decide_reviews(jobs)
+    apply_reviews(jobs)
+
+
+def queue_reviews():
+    """
+    Run the automatic checks on reviewable jobs that aren't queued, yet.
+    Approve the ones that pass, and queue the others, with their comments.
+    The API calls are made concurrently.
+    Return every reviewable job, by id.
+    """
+    Review.prune()
+    queued = Review.get_queued_ids()
+    jobs = {}
+    approvable = []
+    problematic = []
+    for job in Job.get_reviewable():
+        jobs[job.id] = job
+        if job.id in queued:
+            continue
         auto_checks = check_translation(job)
 
         if auto_checks is None:
-            approve(job)
+            approvable.append(job)
+        else:
+            problematic.append((job, auto_checks))
+
+    for _ in api_map(approve, approvable):
+        pass
+
+    # Fetch every thread before saving, so the write transaction doesn't
+    # wait on the API
+    threads = list(api_map(get_comments, [job for job, _ in problematic]))
+    Review.save_many(
+        Review(job_id=job.id, message=auto_checks, thread=json.dumps(thread),
+               decision=None, comment=None)
+        for (job, auto_checks), thread in itertools.izip(problematic,
+                                                         threads))
+    return jobs
+
+
+def decide_reviews(jobs):
+    """Ask for a decision on every queued review. Doesn't use the API"""
+    for review in list(Review.get_undecided()):
+        decision, comment = manual_review(jobs[review.job_id], review.message,
+                                          json.loads(review.thread))
+        if decision:
+            review.decision = decision
+            review.comment = comment
+            review.save()
+
+
+def apply_review(job, review):
+    """Send a review decision to Gengo. Return None, or the error"""
+    from gengo import GengoError
+    import requests
+
+    try:
+        if review.decision == 'approve':
+            gengo().updateTranslationJob(id=job.id,
+                                         action={'action': 'approve'})
+        else:
+            revise(job, review.comment)
+    except (GengoError, requests.RequestException) as e:
+        return e
+
+
+def apply_reviews(jobs):
+    """
+    Send every review decision to Gengo, concurrently. Failed ones stay in
+    the queue, for the next run.
+    """
+    reviews = list(Review.get_decided())
+    results = api_map(lambda review: apply_review(jobs[review.job_id],
+                                                  review),
+                      reviews)
+    applied = []
+    for review, error in itertools.izip(reviews, results):
+        if error:
+            print 'Failed to %s job %s: %s' % (review.decision,
+                                               review.job_id, error)
         else:
-            manual_review(job, auto_checks)
+            applied.append(review.job_id)
+    if applied:
+        Review.delete_where(
+            'job_id IN (%s)' % ', '.join('?' for id in applied), applied)
 
 
 def approve(job):
+    from gengo import GengoError
+
     try:
         gengo().updateTranslationJob(id=job.id,
                                      action={'action': 'approve'})
@@ -321,6 +966,8 @@ def approve(job):
 
 
 def revise(job, comment=None):
+    import cgi
+
     if not comment:
         comment = raw_input('Comment: ')
 
@@ -333,7 +980,16 @@ def revise(job, comment=None):
     })
 
 
-def manual_review(job, message):
+def get_comments(job):
+    r = gengo().getTranslationJobComments(id=job.id)
+    return r['response']['thread']
+
+
+def manual_review(job, message, thread=None):
+    """
+    Show a job to the reviewer. Return their decision ('approve', 'revise'
+    or None to skip) and revision comment
+    """
     print '\nReview reviewable translation:', job.id
     print '===== en ====='
     print job.source
@@ -342,8 +998,8 @@ def manual_review(job, message):
     print '=============='
     print message
     print '=============='
-    r = gengo().getTranslationJobComments(id=job.id)
-    thread = r['response']['thread']
+    if thread is None:
+        thread = get_comments(job)
     if thread:
         for comment in thread[1:]:
             comment['ctime_date'] = time.strftime(
@@ -354,57 +1010,97 @@ def manual_review(job, message):
         action = raw_input('Action? [A]pprove, [R]evise, S[k]ip: ')
         action = action.lower().strip()
         if action == '':
-            revise(job, message)
-            break
+            return 'revise', message
         elif action == 'a':
-            approve(job)
-            break
+            return 'approve', None
         elif action == 'r':
-            revise(job)
-            break
+            return 'revise', raw_input('Comment: ') or message
         elif action == 'k':
-            break
+            return None, None
 
 
-def walk_json_files(locale_dir, languages, edit_jobs):
+def walk_json_files(locale_dir, languages, edit_jobs, job_indexes=None):
+    if job_indexes is None:
+        job_indexes = {}
     jobs = []
     with open(os.path.join(locale_dir, 'en.json')) as f:
         source_messages = json.load(f)
 
     for language in languages:
+        known_jobs = get_job_index(job_indexes, language)
         jobs.extend(
-            walk_json_file(source_messages, language, locale_dir, edit_jobs)
+            walk_json_file(source_messages, language, locale_dir, edit_jobs,
+                           known_jobs)
         )
 
     return jobs
 
 
-def walk_json_file(source_messages, language, locale_dir, edit_jobs):
+def walk_json_file(source_messages, language, locale_dir, edit_jobs,
+                   known_jobs=None, catalogs=None, memory=None):
+    """
+    Walk through a JSON catalog and yield any jobs that need to be
+    submitted. source_messages is loaded from en.json, if None.
+    memory is ignored: JSON catalogs can't mark a suggestion as fuzzy.
+    """
     updated = False
-    filename = os.path.join(locale_dir, '{}.json'.format(language))
+    if known_jobs is None:
+        known_jobs = Job.get_index(language)
+    filename = json_file(locale_dir, language)
+    # The source file is part of the catalog, too
+    source_filename = json_file(locale_dir, 'en')
+    filenames = [source_filename, filename]
     if DEBUG:
         print 'Processing %s' % filename
+    pending = None
+    if os.path.exists(filename):
+        pending = unchanged_catalog_pending(filename, filenames, known_jobs,
+                                            catalogs)
+    if pending is not None:
+        sys.stdout.write('Creating jobs for "{}" locale'.format(language))
+        if DEBUG:
+            sys.stdout.write(' (unchanged)')
+        sys.stdout.flush()
+        for job in walk_pending(pending, language, edit_jobs, known_jobs):
+            yield job
+            sys.stdout.write('.')
+            sys.stdout.flush()
+        if COMPILE:
+            compile_json_file(filename)
+        print
+        return
+
+    if source_messages is None:
+        with open(source_filename) as f:
+            source_messages = json.load(f)
     translations = open_or_create_json_file(filename)
     sys.stdout.write('Creating jobs for "{}" locale'.format(language))
     sys.stdout.flush()
 
+    pending = []
     for message in source_messages:
         if message in translations:
             continue
 
-        job = Job.find(language, message)
+        job = known_jobs.get(message)
         if job:
             if job.status == 'approved':
                 translations[message] = job.translation
                 updated = True
+            else:
+                pending.append((message, None))
             continue
 
+        pending.append((message, None))
         yield get_job_data(message, language, edit_jobs)
         sys.stdout.write('.')
         sys.stdout.flush()
     if updated:
         print '\nSaving approved messages'
         write_json_file(filename, translations)
+    if COMPILE:
+        compile_json_file(filename, translations)
+    record_catalog(filename, filenames, pending, catalogs)
     print
 
 
@@ -421,21 +1117,233 @@ def open_or_create_json_file(filename):
 
 
 def write_json_file(filename, json_data):
-    with io.open(filename, mode='w', encoding='utf-8') as f:
-        json_data = json.dumps(
-            json_data,
-            f,
-            sort_keys=True,
-            indent=2,
-            ensure_ascii=False,
-            separators=(',', ': '),  # removes trailing space
-        )
-        f.write(unicode(json_data))
+    return write_json(filename, json_data)
+
+
+def get_catalog_walks(config, projects, languages=None):
+    """
+    Yield (language, catalog path, walker, walker arguments) for every
+    catalog in projects
+    """
+    for project in projects:
+        print '\nProcessing "{}" project'.format(project)
+        project_languages = (languages or
+                             config.get(project, 'languages').split())
+        edit_jobs = config.getboolean(project, 'edit_jobs')
+        if edit_jobs:
+            print 'Jobs will be ordered with "Editing Service"'
+        try:
+            locale_dir = config.get(project, 'locale_dir')
+        except ConfigParser.NoOptionError:
+            locale_dir = None
+
+        if locale_dir:
+            # process newer projects with JSON based translations
+            for language in project_languages:
+                yield (language, json_file(locale_dir, language),
+                       walk_json_file, (None, language, locale_dir, edit_jobs))
+        else:
+            for domain in config.get(project, 'domains').split():
+                basedir = config.get(project, domain)
+                for language in project_languages:
+                    yield (language, po_file(basedir, language, domain),
+                           walk_po_file,
+                           (basedir, language, domain, edit_jobs))
+
+
+def walk_catalogs(walks):
+    """Walk every catalog in walks (from get_catalog_walks) and return jobs"""
+    jobs = []
+    job_indexes = {}
+    memories = {}
+    for language, path, walker, walker_args in walks:
+        known_jobs = get_job_index(job_indexes, language)
+        memory = get_memory(memories, language, known_jobs)
+        jobs.extend(walker(*walker_args, known_jobs=known_jobs,
+                           memory=memory))
+    return jobs
+
+
+def job_key(job):
+    """What makes a job (from get_job_data) a duplicate of another"""
+    return (job['lc_tgt'], job['body_src'], tuple(job.get('services', ())))
+
+
+def dedupe_jobs(jobs):
+    """
+    Coalesce jobs for the same message, target language and services, from
+    different catalogs. Every catalog looks the translation up by
+    (language, message), so one job is enough for all of them.
+    """
+    unique = collections.OrderedDict()
+    for job in jobs:
+        unique.setdefault(job_key(job), job)
+    if DEBUG and len(unique) < len(jobs):
+        print 'Skipping {} duplicate jobs'.format(len(jobs) - len(unique))
+    return unique.values()
+
+
+# The DB connections that worker processes inherited from their parent
+_inherited_dbs = []
+
+
+def init_walk_worker():
+    # Never use the parent's DB connection. Nor close it: closing the last
+    # connection to a WAL database would checkpoint it, and delete the WAL,
+    # under the parent. Workers exit without collecting it.
+    _inherited_dbs.append(orm.db)
+    orm.db = None
+
+
+def walk_catalog_in_worker(task):
+    """
+    Walk a catalog in a worker process.
+    Return the jobs and the updated Catalogs, for the parent to store.
+    """
+    language, walker, walker_args, known_jobs, catalogs = task
+    memory = get_memory({}, language, known_jobs)
+    jobs = list(walker(*walker_args, known_jobs=known_jobs,
+                       catalogs=catalogs, memory=memory))
+    return jobs, catalogs.values()
+
+
+def walk_catalogs_in_parallel(walks, processes):
+    """
+    Walk every catalog in walks (from get_catalog_walks) in a pool of
+    worker processes, and return jobs.
+    Workers get snapshots of the jobs and Catalog records they need, and
+    build their own translation memories. This process does all the DB
+    writes.
+    """
+    import multiprocessing
+
+    job_indexes = {}
+    tasks = []
+    for language, path, walker, walker_args in walks:
+        catalog = Catalog.get_where('path = ?', (path,))
+        catalogs = {path: catalog} if catalog else {}
+        tasks.append((language, walker, walker_args,
+                      get_job_index(job_indexes, language), catalogs))
+
+    jobs = []
+    pool = multiprocessing.Pool(processes, initializer=init_walk_worker)
+    try:
+        for catalog_jobs, catalogs in pool.imap(walk_catalog_in_worker,
+                                                 tasks):
+            jobs.extend(catalog_jobs)
+            Catalog.save_many(catalogs)
+    finally:
+        pool.terminate()
+        pool.join()
+    return jobs
+
+
+def wait_for_callbacks(job_ids, timeout):
+    """
+    Wait up to timeout seconds for callbacks. Return the set of job ids
+    that have been called back, or None if there were none.
+    """
+    try:
+        called_back = set([job_ids.get(timeout=max(timeout, 0))])
+    except Queue.Empty:
+        return None
+    # Callbacks come in bursts. Handle them together.
+    time.sleep(CALLBACK_DELAY)
+    while True:
+        try:
+            called_back.add(job_ids.get_nowait())
+        except Queue.Empty:
+            return called_back
+
+
+def merge_approved(config, projects, languages, approved):
+    """Walk only the catalogs for the languages of the approved jobs"""
+    affected = set(job.lang for job in approved)
+    walks = [walk for walk in get_catalog_walks(config, projects, languages)
+             if walk[0] in affected]
+    # New jobs are left for a one-shot run to order
+    walk_catalogs(walks)
+
+
+def watch(config, projects, languages, interval, callback_port=None):
+    """
+    Keep syncing jobs: poll them every interval seconds, and as soon as
+    Gengo calls back, if callback_port is set. Merge approved translations
+    into the affected catalogs as they arrive.
+    API errors are reported, and retried with an exponential backoff.
+    """
+    from gengo import GengoError
+    import requests
+
+    job_ids = Queue.Queue()
+    server = None
+    if callback_port is not None:
+        from callbacks import start_callback_server
+        server = start_callback_server(callback_port, job_ids, DEBUG)
+    # Merge anything that was approved before we started
+    walk_catalogs(get_catalog_walks(config, projects, languages))
+    next_poll = time.time()
+    # Approved jobs that haven't been merged, yet
+    approved = []
+    failures = 0
+    try:
+        while True:
+            called_back = wait_for_callbacks(job_ids,
+                                             next_poll - time.time())
+            try:
+                if called_back:
+                    approved += update_statuses(called_back)
+                else:
+                    with METRICS.phase('resume_orders'):
+                        resume_orders()
+                    with METRICS.phase('update_db'):
+                        update_db()
+                    with METRICS.phase('update_statuses'):
+                        approved += update_statuses()
+                    next_poll = time.time() + interval
+                if approved:
+                    print '%i jobs approved' % len(approved)
+                    with METRICS.phase('merge'):
+                        merge_approved(config, projects, languages, approved)
+                    approved = []
+            except (GengoError, requests.RequestException,
+                    sqlite3.OperationalError, IOError) as e:
+                # e.g. the API is down, the DB is locked by another run, or
+                # a catalog is being deployed. A full poll picks up any
+                # called back jobs we missed.
+                delay = min(interval, RETRY_DELAY * 2 ** failures)
+                failures += 1
+                print 'Sync failed: %s. Retrying in %i seconds' % (e, delay)
+                next_poll = time.time() + delay
+            else:
+                failures = 0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.shutdown()
+
+
+def threshold(value):
+    """A similarity threshold, for argparse"""
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise argparse.ArgumentTypeError('%s is not between 0 and 1' % value)
+    return value
 
 
 def main(**kwargs):
-    global DEBUG, MAX_CONT, COMMENT, DB_NAME
+    global DEBUG, MAX_COST, COMMENT, DB_NAME, CONCURRENCY, RATE_LIMIT, \
+        FULL_SCAN, ORDER_TIMEOUT, BATCH_SIZE, TRANSLATION_MEMORY, \
+        QUEUE_REVIEWS, RESPONSE_CACHE, LEASE_TTL, COMPILE
     p = argparse.ArgumentParser()
+    p.add_argument('command', nargs='?', default='all',
+                   choices=('all', 'sync', 'review', 'scan', 'order'),
+                   help='sync: update the DB from Gengo. review: review '
+                        'translations. scan: merge approved translations '
+                        'into the catalogs, and count the messages that '
+                        "need jobs. Doesn't use the API. order: scan, and "
+                        'order the jobs. Default: all of them')
     p.add_argument('-p', '--project', action='append', dest='projects',
                    help='Only look at the specified projects. '
                          'Can be repeated. Default: all')
@@ -448,6 +1356,72 @@ def main(**kwargs):
                    help='Display debugging messages')
     p.add_argument('-d', '--database', default='jobs.db',
                    help='Local jobs database (default: jobs.db)')
+    p.add_argument('--full-scan', action='store_true',
+                   help="Walk every catalog, even if it hasn't changed since "
+                        'the last run')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='Walk catalogs in this many processes (default: 1)')
+    p.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                   help='Maximum simultaneous Gengo API requests '
+                        '(default: %i)' % CONCURRENCY)
+    p.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                   help='Maximum Gengo API requests per second '
+                        '(default: unlimited)')
+    p.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                   help='Jobs per quote and order request '
+                        '(default: %i)' % BATCH_SIZE)
+    p.add_argument('--order-timeout', type=int, default=ORDER_TIMEOUT,
+                   help='Seconds to wait for a new order to be processed, '
+                        'before leaving it for the next run '
+                        '(default: %i)' % ORDER_TIMEOUT)
+    p.add_argument('--translation-memory', type=threshold, nargs='?',
+                   const=1.0, metavar='THRESHOLD',
+                   help='Fill PO catalogs with fuzzy suggestions from '
+                        'approved jobs and translated messages, instead of '
+                        'ordering jobs. Suggest matches with a similarity '
+                        'of at least THRESHOLD, between 0 and 1 (default: '
+                        '1, only whitespace and case may differ)')
+    p.add_argument('--compile', action='store_true',
+                   help='Compile PO catalogs to .mo files, and minify JSON '
+                        'catalogs to .min.json files, next to them. Only '
+                        "catalogs that changed, or haven't been compiled, "
+                        'are compiled')
+    p.add_argument('--queue-reviews', action='store_true',
+                   help='Queue jobs that need a manual review, and apply '
+                        "earlier decisions, but don't ask for new ones")
+    p.add_argument('--watch', action='store_true',
+                   help='Keep running, syncing job statuses and merging '
+                        'approved translations into their catalogs. '
+                        "Doesn't review or order jobs")
+    p.add_argument('--interval', type=int, default=300,
+                   help='Seconds between polls, in --watch mode '
+                        '(default: 300)')
+    p.add_argument('--callback-port', type=int, metavar='PORT',
+                   help='In --watch mode, serve Gengo job callbacks on '
+                        'PORT, and sync called back jobs straight away')
+    p.add_argument('--shared', action='store_true',
+                   help='Share the work with other --shared runs using the '
+                        'same database, from this host or others')
+    p.add_argument('--lease-ttl', type=int, default=LEASE_TTL,
+                   help='In --shared mode, seconds before the work a run '
+                        'claimed can be taken over by another run '
+                        '(default: %i)' % LEASE_TTL)
+    p.add_argument('--cache', metavar='FILE',
+                   help='Cache API responses that rarely change in FILE, '
+                        'e.g. responses.db. Review comments may then be up '
+                        'to an hour old')
+    p.add_argument('--metrics', metavar='FILE',
+                   help='Write API, DB and phase timings to FILE')
+    p.add_argument('--metrics-format', choices=('json', 'prometheus'),
+                   default='json',
+                   help='Format for --metrics: JSON, or a Prometheus '
+                        'textfile (default: json)')
+    p.add_argument('--pragma', action='append', default=[],
+                   metavar='NAME=VALUE',
+                   help='SQLite PRAGMA to set on the jobs database. '
+                        'Can be repeated. Default: %s' % ' '.join(
+                            '%s=%s' % pragma
+                            for pragma in orm.PRAGMAS.iteritems()))
     p.set_defaults(**kwargs)
     args = p.parse_args()
 
@@ -455,7 +1429,21 @@ def main(**kwargs):
     config.readfp(args.config)
 
     DEBUG = args.verbose
+    FULL_SCAN = args.full_scan
+    CONCURRENCY = args.concurrency
+    RATE_LIMIT = args.rate_limit
+    ORDER_TIMEOUT = args.order_timeout
+    BATCH_SIZE = args.batch_size
+    TRANSLATION_MEMORY = args.translation_memory
+    QUEUE_REVIEWS = args.queue_reviews
+    RESPONSE_CACHE = args.cache
+    LEASE_TTL = args.lease_ttl
+    COMPILE = args.compile
     orm.DB_NAME = args.database
+    for pragma in args.pragma:
+        name, value = pragma.split('=', 1)
+        orm.PRAGMAS[name.strip()] = value.strip()
+    orm.on_query = METRICS.record_query
 
     projects = args.projects or config.sections()
     if 'GLOBAL' in projects:
@@ -464,42 +1452,263 @@ def main(**kwargs):
     COMMENT = config.get('GLOBAL', 'comment')
     MAX_COST = config.getint('GLOBAL', 'max_cost')
 
-    update_db()
-    update_statuses()
-    review()
+    try:
+        if args.watch:
+            watch(config, projects, args.languages, args.interval,
+                  args.callback_port)
+        elif args.shared:
+            run_shared(config, projects, args)
+        else:
+            run(config, projects, args)
+    finally:
+        if args.metrics:
+            METRICS.write(args.metrics, args.metrics_format)
 
-    jobs = []
-    for project in projects:
-        print '\nProcessing "{}" project'.format(project)
-        languages = args.languages or config.get(project, 'languages').split()
-        edit_jobs = config.getboolean(project, 'edit_jobs')
-        if edit_jobs:
-            print 'Jobs will be ordered with "Editing Service"'
-        try:
-            locale_dir = config.get(project, 'locale_dir')
-        except ConfigParser.NoOptionError:
-            locale_dir = None
 
-        if locale_dir:
-            # process newer projects with JSON based translations
-            jobs.extend(walk_json_files(locale_dir, languages, edit_jobs))
+def sync():
+    """
+    Bring the DB up to date with Gengo.
+    Return True if there are no pending orders left.
+    """
+    with METRICS.phase('resume_orders'):
+        orders_done = resume_orders()
+    with METRICS.phase('update_db'):
+        update_db()
+    with METRICS.phase('confirm_posts'):
+        confirm_posts()
+    with METRICS.phase('update_statuses'):
+        update_statuses()
+    return orders_done
+
+
+def scan(config, projects, args):
+    """
+    Walk the catalogs, merging in approved translations.
+    Return the jobs that need to be ordered.
+    """
+    walks = get_catalog_walks(config, projects, args.languages)
+    with METRICS.phase('scan'):
+        if args.jobs > 1:
+            jobs = walk_catalogs_in_parallel(walks, args.jobs)
         else:
-            for domain in config.get(project, 'domains').split():
-                basedir = config.get(project, domain)
-                for language in languages:
-                    jobs.extend(
-                        walk_po_file(basedir, language, domain, edit_jobs)
-                    )
+            jobs = walk_catalogs(walks)
+    jobs = dedupe_jobs(jobs)
 
     if DEBUG:
         print '{} new jobs'.format(len(jobs))
         print json.dumps(jobs, indent=2)
-    if jobs:
-        if quote_jobs(jobs) > MAX_COST:
+    return jobs
+
+
+def order(jobs, orders_done, posted=None):
+    """
+    Quote and post jobs. Return the ones that weren't posted.
+    posted is passed on to post_jobs.
+    """
+    unconfirmed = set(entry.key for entry in Unconfirmed.get_all_where('1'))
+    held = [job for job in jobs if json.dumps(job_key(job)) in unconfirmed]
+    if held:
+        # Gengo may have ordered them already
+        print ('Not ordering %i jobs until we know whether a failed post '
+               'ordered them' % len(held))
+        jobs = [job for job in jobs
+                if json.dumps(job_key(job)) not in unconfirmed]
+    if jobs and not orders_done:
+        # Their jobs aren't in the DB, yet, so we'd order them again
+        print 'Not ordering new jobs until the pending orders are processed'
+        return held + jobs
+    elif jobs:
+        with METRICS.phase('quote_jobs'):
+            cost = quote_jobs(jobs)
+        if cost > MAX_COST:
             print "Too expensive, aborting"
             sys.exit(1)
         raw_input('OK?')
-        post_jobs(jobs)
+        with METRICS.phase('post_jobs'):
+            return held + post_jobs(jobs, posted)
+    return held
+
+
+def lease_owner():
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+def renew_lease(name, owner, stop):
+    """
+    Renew a lease every LEASE_TTL / 3 seconds, on a connection of its own,
+    until stop (a threading.Event) is set
+    """
+    connection = None
+    try:
+        while not stop.wait(LEASE_TTL / 3.0):
+            try:
+                connection = connection or orm.connect(orm.DB_NAME)
+                if not Lease.acquire(name, owner, LEASE_TTL, connection):
+                    print ('WARNING: Another run took over %s. Was this one '
+                           'stopped for over %i seconds?' % (name, LEASE_TTL))
+                    LOST_LEASES.add(name)
+                    return
+            except sqlite3.OperationalError as e:
+                # e.g. locked by a long write. There's time for another try
+                print 'Failed to renew the lease on %s: %s' % (name, e)
+    finally:
+        if connection:
+            connection.close()
+
+
+@contextlib.contextmanager
+def leased(name):
+    """
+    Hold the lease name for the duration of the block, if nobody else does.
+    Yields whether we got it. The lease is renewed in the background for as
+    long as the block runs, however long that is (e.g. waiting for someone
+    to confirm an order). If the block fails, the lease is kept until it
+    expires, so that other runs don't retry the work straight away.
+    """
+    owner = lease_owner()
+    if not Lease.acquire(name, owner, LEASE_TTL):
+        print 'Skipping %s: Another run is working on it' % name
+        yield False
+        return
+    LOST_LEASES.discard(name)
+    stop = threading.Event()
+    renewer = threading.Thread(target=renew_lease, args=(name, owner, stop))
+    renewer.daemon = True
+    renewer.start()
+    try:
+        yield True
+    finally:
+        stop.set()
+        renewer.join()
+    Lease.release(name, owner)
+
+
+def get_shards(config, projects, languages=None):
+    """
+    Group the walks from get_catalog_walks into units of work that
+    separate runs can do concurrently. Yield ((project, language), walks).
+    """
+    for project in projects:
+        shards = collections.OrderedDict()
+        for walk in get_catalog_walks(config, [project], languages):
+            shards.setdefault(walk[0], []).append(walk)
+        for language, walks in shards.iteritems():
+            yield (project, language), walks
+
+
+def queue_jobs(jobs):
+    """Add jobs to the Outbox, for the order step"""
+    now = time.time()
+    Outbox.add(Outbox(key=json.dumps(job_key(job)), job=json.dumps(job),
+                      created=now)
+               for job in jobs)
+
+
+def order_outbox(orders_done):
+    """
+    Order the jobs in the Outbox that haven't been ordered, yet.
+    Only the run holding the order lease may call this. post_jobs stops
+    posting them if another run takes the lease over.
+    """
+    if 'order' in LOST_LEASES:
+        print 'Not ordering queued jobs: another run took over the order lease'
+        return
+    queued = list(Outbox.get_all_where('1 ORDER BY created, key'))
+    jobs = []
+    for entry in queued:
+        job = json.loads(entry.job)
+        # Another run may have ordered it, since it was queued
+        if not Job.find(gengo_language_to_locale(job['lc_tgt']),
+                        job['body_src']):
+            jobs.append(job)
+    if DEBUG:
+        print '{} queued jobs, {} new'.format(len(queued), len(jobs))
+
+    def posted(batch):
+        # Forget each batch as soon as it may have been ordered, in case we
+        # fail later
+        for job in batch:
+            Outbox.delete_where('key = ?', (json.dumps(job_key(job)),))
+
+    unposted = set(json.dumps(job_key(job))
+                   for job in order(jobs, orders_done, posted))
+    for entry in queued:
+        if entry.key not in unposted:
+            Outbox.delete_where('key = ?', (entry.key,))
+
+
+def run_shared(config, projects, args):
+    """
+    Run args.command alongside other runs sharing the DB, on this host or
+    others. Every step is split into leased units of work, so the runs
+    share it out: syncing orders, each language's statuses, each project
+    and language's catalogs. Scans queue jobs in the Outbox, and a single
+    run at a time orders them, so nothing is ordered twice.
+    """
+    command = args.command
+    if command in ('all', 'sync'):
+        with leased('update_db') as acquired:
+            if acquired:
+                with METRICS.phase('resume_orders'):
+                    resume_orders()
+                with METRICS.phase('update_db'):
+                    update_db()
+        languages = sorted(set(job.lang for job in Job.get_in_progress()))
+        for lang in languages:
+            with leased('sync:%s' % lang) as acquired:
+                if acquired:
+                    with METRICS.phase('update_statuses'):
+                        update_statuses(lang=lang)
+    if command in ('all', 'review'):
+        with leased('review') as acquired:
+            if acquired:
+                with METRICS.phase('review'):
+                    review()
+    if command in ('all', 'scan', 'order'):
+        for shard, walks in get_shards(config, projects, args.languages):
+            with leased('scan:%s:%s' % shard) as acquired:
+                if acquired:
+                    with METRICS.phase('scan'):
+                        jobs = dedupe_jobs(walk_catalogs(walks))
+                    queue_jobs(jobs)
+        if command == 'scan':
+            print '{} queued jobs'.format(len(list(Outbox.get_all_where('1'))))
+    if command in ('all', 'order'):
+        with leased('order') as acquired:
+            if acquired:
+                with METRICS.phase('resume_orders'):
+                    orders_done = resume_orders()
+                # The jobs of orders that just finished resuming don't have
+                # their messages yet, and the outbox may hold them again
+                with METRICS.phase('update_statuses'):
+                    update_statuses(job_ids=set(
+                        job.id for job in Job.get_in_progress()
+                        if job.source is None))
+                # Find any orders that an earlier post may have created
+                with METRICS.phase('update_db'):
+                    update_db()
+                with METRICS.phase('confirm_posts'):
+                    confirm_posts()
+                order_outbox(orders_done)
+
+
+def run(config, projects, args):
+    """Run args.command: a single step, or all of them"""
+    command = args.command
+    # Ordering needs a full sync first: an order that finishes resuming
+    # only gets its jobs' messages from update_statuses, and the scan
+    # would order them again without them
+    if command in ('all', 'sync', 'order'):
+        orders_done = sync()
+    if command in ('all', 'review'):
+        with METRICS.phase('review'):
+            review()
+    if command in ('all', 'scan', 'order'):
+        jobs = scan(config, projects, args)
+        if command == 'scan':
+            print '{} new jobs'.format(len(jobs))
+    if command in ('all', 'order'):
+        order(jobs, orders_done)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+A read-only HTTP service that looks up approved translations in the jobs
+database, so preview environments can use them as soon as they're
+approved, before they're merged into catalogs and deployed.
+
+    GET /translation?lang=fr&source=Hello
+        {"translation": "Bonjour"}, or a 404
+    POST /translations {"lang": "fr", "sources": ["Hello", "Bye"]}
+        {"translations": {"Hello": "Bonjour", "Bye": null}}
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import SocketServer
+import sqlite3
+import threading
+import urlparse
+
+import orm
+
+
+# SQLite's default limit on query parameters is 999
+LOOKUP_BATCH_SIZE = 500
+
+
+class LRUCache(object):
+    """A dict of up to size items, that forgets the least recently used"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def set(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+
+class TranslationStore(object):
+    """
+    Approved translations from a jobs database, by language and source
+    message, with the hottest ones (and misses) cached. The cache is
+    dropped whenever another connection commits to the database, e.g.
+    when update_statuses saves new approvals.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, filename, cache_size=10000):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA query_only = ON;')
+        for pragma in ('mmap_size', 'cache_size'):
+            self.db.execute('PRAGMA %s = %s;' % (pragma, orm.PRAGMAS[pragma]))
+        version = self.db.execute('PRAGMA user_version;').fetchone()[0]
+        if version != len(orm.MIGRATIONS):
+            raise ValueError('%s is not an up to date jobs database. Run '
+                             'gengogettext.py on it, first' % filename)
+        self.cache = LRUCache(cache_size)
+        self.data_version = self._data_version()
+
+    def _data_version(self):
+        return self.db.execute('PRAGMA data_version;').fetchone()[0]
+
+    def reload(self):
+        """Drop the cache if the database has changed. Return whether it has"""
+        data_version = self._data_version()
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+        self.cache.clear()
+        return True
+
+    def lookup(self, lang, source):
+        """Return the approved translation of source into lang, or None"""
+        return self.lookup_many(lang, [source])[source]
+
+    def lookup_many(self, lang, sources):
+        """Return a {source: approved translation, or None} dict"""
+        translations = {}
+        with self.lock:
+            self.reload()
+            missing = {}
+            for source in sources:
+                if (lang, source) in self.cache:
+                    translations[source] = self.cache.get((lang, source))
+                else:
+                    missing[orm.string_id(source)] = source
+            found = self._query(lang, missing.keys())
+            for source_id, source in missing.iteritems():
+                translations[source] = found.get(source_id)
+                self.cache.set((lang, source), translations[source])
+        return translations
+
+    def _query(self, lang, source_ids):
+        """Return a {source id: translation} dict of approved jobs"""
+        found = {}
+        for i in range(0, len(source_ids), LOOKUP_BATCH_SIZE):
+            batch = source_ids[i:i + LOOKUP_BATCH_SIZE]
+            # Newest first, so that the oldest approved job wins
+            c = self.db.execute(
+                """SELECT source_id, translation FROM job_text
+                   WHERE lang = ? AND source_id IN (%s)
+                   AND status = 'approved' ORDER BY id DESC;"""
+                % ', '.join('?' for source_id in batch), [lang] + batch)
+            for source_id, translation in c:
+                found[source_id] = translation
+        return found
+
+    def close(self):
+        self.db.close()
+
+
+class LookupHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers lookups from server.store (a TranslationStore)"""
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/translation':
+            return self.send_json(404, {'error': 'Not found'})
+        query = urlparse.parse_qs(url.query)
+        try:
+            lang = query['lang'][0]
+            source = query['source'][0].decode('utf-8')
+        except (KeyError, UnicodeDecodeError):
+            return self.send_json(400, {'error': 'Expected lang and source'})
+        translation = self.server.store.lookup(lang, source)
+        if translation is None:
+            return self.send_json(404, {'error': 'No approved translation'})
+        self.send_json(200, {'translation': translation})
+
+    def do_POST(self):
+        if self.path != '/translations':
+            return self.send_json(404, {'error': 'Not found'})
+        length = int(self.headers.getheader('content-length', 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            lang = request['lang']
+            sources = request['sources']
+            if not all(isinstance(source, basestring) for source in sources):
+                raise TypeError()
+        except (KeyError, TypeError, ValueError):
+            return self.send_json(400, {'error': 'Expected lang and sources'})
+        self.send_json(200, {
+            'translations': self.server.store.lookup_many(lang, sources)})
+
+    def send_json(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class LookupServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_lookup_server(store, host, port, verbose=False):
+    """An HTTP server for lookups in store, on host and port"""
+    server = LookupServer((host, port), LookupHandler)
+    server.store = store
+    server.verbose = verbose
+    return server
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description='Serve approved translations from a jobs database')
+    p.add_argument('-d', '--database', default='jobs.db',
+                   help='Local jobs database (default: jobs.db)')
+    p.add_argument('--host', default='127.0.0.1',
+                   help='Address to listen on (default: 127.0.0.1)')
+    p.add_argument('--port', type=int, default=8011,
+                   help='Port to listen on (default: 8011)')
+    p.add_argument('--cache-size', type=int, default=10000,
+                   help='Lookups to cache (default: 10000)')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='Log every request')
+    args = p.parse_args()
+
+    store = TranslationStore(args.database, args.cache_size)
+    server = make_lookup_server(store, args.host, args.port, args.verbose)
+    print 'Serving translations from %s on http://%s:%i/' % (
+        args.database, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
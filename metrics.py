@@ -0,0 +1,199 @@
+"""Per-run instrumentation: Gengo API calls, DB queries and phase timings."""
+
+import collections
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def payload_size(data):
+    """The size of data, JSON encoded, as an estimate of bytes on the wire"""
+    try:
+        return len(json.dumps(data, separators=(',', ':')))
+    except (TypeError, ValueError):
+        return 0
+
+
+class Calls(object):
+    """Count, latencies, errors and payload sizes for one kind of call"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def report(self):
+        return {
+            'count': len(self.latencies),
+            'errors': self.errors,
+            'total_seconds': sum(self.latencies),
+            'p50_seconds': percentile(self.latencies, 0.5),
+            'p99_seconds': percentile(self.latencies, 0.99),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api = collections.defaultdict(Calls)
+        self.queries = collections.defaultdict(Calls)
+        self.phases = collections.OrderedDict()
+
+    def record_api_call(self, method, seconds, sent=0, received=0,
+                        error=False):
+        with self.lock:
+            calls = self.api[method]
+            calls.latencies.append(seconds)
+            calls.bytes_sent += sent
+            calls.bytes_received += received
+            calls.errors += bool(error)
+
+    def record_query(self, query, seconds):
+        # Collapse "IN (?, ?, ...)" so each query shape is counted once
+        query = re.sub(r'\(\?(?:, \?)*\)', '(?...)', ' '.join(query.split()))
+        with self.lock:
+            self.queries[query].latencies.append(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Record the wall and CPU time spent in the block. Repeated phases
+        add up, and count how often they ran.
+        """
+        start = time.time()
+        cpu = sum(os.times()[:2])
+        try:
+            yield
+        finally:
+            wall = time.time() - start
+            cpu = sum(os.times()[:2]) - cpu
+            with self.lock:
+                phase = self.phases.setdefault(name, {
+                    'wall_seconds': 0,
+                    'cpu_seconds': 0,
+                    'count': 0,
+                })
+                phase['wall_seconds'] += wall
+                phase['cpu_seconds'] += cpu
+                phase['count'] += 1
+
+    def report(self):
+        with self.lock:
+            return {
+                'phases': self.phases,
+                'api': dict((method, calls.report())
+                            for method, calls in self.api.iteritems()),
+                'queries': dict((query, calls.report())
+                                for query, calls in self.queries.iteritems()),
+            }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Render the report in the Prometheus text exposition format"""
+        report = self.report()
+        lines = []
+
+        # parts are (suffix, samples) pairs, e.g. a summary's _sum and _count
+        def metric(name, type_, samples, parts=()):
+            name = 'gengogettext_' + name
+            lines.append('# TYPE %s %s' % (name, type_))
+            for suffix, part_samples in [('', samples)] + list(parts):
+                for labels, value in part_samples:
+                    if value is None:
+                        continue
+                    lines.append('%s%s{%s} %r' % (name, suffix, ','.join(
+                        '%s="%s"' % (key, escape_label(label))
+                        for key, label in labels), float(value)))
+
+        for key, type_ in (('wall_seconds', 'gauge'),
+                           ('cpu_seconds', 'gauge'),
+                           ('count', 'gauge')):
+            metric('phase_' + key, type_, [
+                ((('phase', phase),), values[key])
+                for phase, values in report['phases'].iteritems()])
+
+        for section, label in (('api', 'method'), ('queries', 'query')):
+            prefix = 'api_' if section == 'api' else 'db_'
+            calls = sorted(report[section].iteritems())
+            metric(prefix + 'calls_total', 'counter', [
+                (((label, key),), values['count']) for key, values in calls])
+            metric(prefix + 'seconds_total', 'counter', [
+                (((label, key),), values['total_seconds'])
+                for key, values in calls])
+            metric(prefix + 'latency_seconds', 'summary', [
+                (((label, key), ('quantile', quantile)), values[percentile])
+                for key, values in calls
+                for quantile, percentile in (('0.5', 'p50_seconds'),
+                                             ('0.99', 'p99_seconds'))],
+                parts=[(suffix, [(((label, key),), values[field])
+                                 for key, values in calls])
+                       for suffix, field in (('_sum', 'total_seconds'),
+                                             ('_count', 'count'))])
+            if section == 'api':
+                for key in ('errors', 'bytes_sent', 'bytes_received'):
+                    metric('api_%s_total' % key, 'counter', [
+                        (((label, method),), values[key])
+                        for method, values in calls])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, format='json'):
+        """Write the report to filename, atomically"""
+        if format == 'prometheus':
+            data = self.to_prometheus()
+        else:
+            data = self.to_json()
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+
+
+def escape_label(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n').encode('utf-8'))
+
+
+class InstrumentedClient(object):
+    """Wraps a Gengo client, recording every API call in metrics"""
+
+    def __init__(self, client, metrics):
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, method):
+        call = getattr(self._client, method)
+
+        def instrumented(**kwargs):
+            start = time.time()
+            try:
+                result = call(**kwargs)
+            except Exception:
+                self._metrics.record_api_call(
+                    method, time.time() - start, payload_size(kwargs),
+                    error=True)
+                raise
+            self._metrics.record_api_call(
+                method, time.time() - start, payload_size(kwargs),
+                payload_size(result))
+            return result
+        return instrumented
+
+
+# The current run's metrics
+METRICS = Metrics()
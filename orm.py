@@ -1,15 +1,52 @@
-import os
+import collections
 import functools
+import hashlib
+import itertools
 import sqlite3
+import struct
+import time
 
 
 db = None
 DB_NAME = None
+# Applied to every connection, in order. Override with main's --pragma
+PRAGMAS = collections.OrderedDict((
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),  # in KiB
+))
+# If set, called with (query, seconds) after every query
+on_query = None
+
+class TableMeta(type):
+    """
+    Give every Table a compact __slots__ row class, with one slot per
+    column, and precompute its SQL statements.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        columns = namespace.get('_columns', ())
+        namespace.setdefault('__slots__', columns)
+        cls = super(TableMeta, mcs).__new__(mcs, name, bases, namespace)
+        column_list = ', '.join('"%s"' % column for column in cls._columns)
+        cls._select_sql = 'SELECT %s FROM "%s" WHERE %%s;' % (
+            column_list, cls._view or cls._table)
+        if '_replace_sql' not in namespace:
+            cls._replace_sql = 'REPLACE INTO "%s" (%s) VALUES (%s);' % (
+                cls._table, column_list, ', '.join('?' for column in columns))
+        cls._setters = [getattr(cls, column).__set__
+                        for column in cls._columns]
+        return cls
+
 
 @functools.total_ordering
 class Table(object):
+    __metaclass__ = TableMeta
     _columns = ()
     _table = None
+    # Read rows from this view, instead of _table
+    _view = None
 
     def __init__(self, *args, **kwargs):
         if len(args) > len(self._columns):
@@ -41,28 +78,43 @@ class Table(object):
                 return True
         return False
 
+    def __reduce__(self):
+        # Slots aren't picklable by default, and a tuple is smaller anyway
+        return _load_row, (self.__class__, tuple(self._values()))
+
+    @classmethod
+    def _from_row(cls, row):
+        """Build a row object from a DB row, skipping __init__'s checks"""
+        self = cls.__new__(cls)
+        for setter, value in itertools.izip(cls._setters, row):
+            setter(self, value)
+        return self
+
+    @classmethod
+    def _replace_query(cls):
+        return cls._replace_sql
+
+    def _values(self):
+        return [getattr(self, column) for column in self._columns]
+
+    def _replace_values(self):
+        """The parameters for _replace_sql"""
+        return self._values()
+
     def save(self):
-        db = get_db()
-        query = 'REPLACE INTO "%s" (%s) VALUES (%s);' % (
-            self._table,
-            ', '.join('"%s"' % column for column in self._columns),
-            ', '.join('?' for column in self._columns))
-        c = db.cursor()
-        c.execute(query, [getattr(self, column) for column in self._columns])
-        db.commit()
+        self.save_many([self])
+
+    @classmethod
+    def save_many(cls, rows):
+        """Save all rows in a single transaction"""
+        with get_db():
+            execute(cls._replace_query(),
+                    (row._replace_values() for row in rows), many=True)
 
     @classmethod
     def get_all_where(cls, where_clause, parameters=()):
-        db = get_db()
-        c = db.cursor()
-        c.execute(
-            'SELECT %s FROM "%s" WHERE %s;' % (
-                ', '.join('"%s"' % column for column in cls._columns),
-                cls._table,
-                where_clause
-            ), parameters)
-        for row in c:
-            yield cls(*row)
+        for row in select(cls._select_sql % where_clause, parameters):
+            yield cls._from_row(row)
 
     @classmethod
     def get_where(cls, where_clause, parameters=()):
@@ -71,15 +123,61 @@ class Table(object):
         except StopIteration:
             return None
 
+    @classmethod
+    def delete_where(cls, where_clause, parameters=()):
+        with get_db():
+            execute('DELETE FROM "%s" WHERE %s;' % (cls._table, where_clause),
+                    parameters)
+
+
+def _load_row(cls, row):
+    return cls._from_row(row)
+
+
+def string_id(text):
+    """
+    The id of text in the string table: 64 bits of its SHA-1, so it can be
+    computed without a lookup
+    """
+    if text is None:
+        return None
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return struct.unpack('>q', hashlib.sha1(text).digest()[:8])[0]
+
 
 class Job(Table):
     _columns = ('id', 'order_id', 'lang', 'source', 'translation', 'status')
     _table = 'job'
+    # The job table refers to the source and translation in the string
+    # table. job_text joins them back in.
+    _view = 'job_text'
+    _replace_sql = ('REPLACE INTO "job" (id, order_id, lang, source_id, '
+                    'translation_id, status) VALUES (?, ?, ?, ?, ?, ?);')
+
+    def _replace_values(self):
+        return [self.id, self.order_id, self.lang, string_id(self.source),
+                string_id(self.translation), self.status]
+
+    def _strings(self):
+        for text in (self.source, self.translation):
+            if text is not None:
+                yield string_id(text), text
+
+    @classmethod
+    def save_many(cls, rows):
+        rows = list(rows)
+        with get_db():
+            execute('INSERT OR IGNORE INTO string (id, text) VALUES (?, ?);',
+                    (string for row in rows for string in row._strings()),
+                    many=True)
+            execute(cls._replace_sql,
+                    (row._replace_values() for row in rows), many=True)
 
     @classmethod
     def create_table(cls, cursor):
         cursor.execute(
-            """CREATE TABLE job (
+            """CREATE TABLE IF NOT EXISTS job (
                     id INTEGER PRIMARY KEY,
                     order_id INTEGER REFERENCES "order" (id),
                     lang TEXT,
@@ -87,13 +185,31 @@ class Job(Table):
                     translation TEXT,
                     status TEXT
                 );""")
+        cursor.execute('CREATE INDEX IF NOT EXISTS job_lang_string '
+                       'ON job (lang, source);')
         cursor.execute(
-            'CREATE INDEX job_lang_string ON job (lang, source);')
-        cursor.execute('CREATE INDEX job_status ON job (status);')
+            'CREATE INDEX IF NOT EXISTS job_status ON job (status);')
 
     @classmethod
     def find(cls, lang, source):
-        return cls.get_where('lang = ? AND source = ?', (lang, source))
+        return cls.get_where('lang = ? AND source_id = ?',
+                             (lang, string_id(source)))
+
+    @classmethod
+    def get_known_ids(cls, ids):
+        """Return the set of ids that are in the DB"""
+        ids = list(ids)
+        rows = select('SELECT id FROM job WHERE id IN (%s);'
+                      % ', '.join('?' for id in ids), ids)
+        return set(row[0] for row in rows)
+
+    @classmethod
+    def get_index(cls, lang):
+        """Return a {source: job} dict of every job for lang"""
+        index = {}
+        for job in cls.get_all_where('lang = ? ORDER BY id', (lang,)):
+            index.setdefault(job.source, job)
+        return index
 
     @classmethod
     def get_in_progress(cls):
@@ -111,22 +227,336 @@ class Order(Table):
     @classmethod
     def create_table(cls, cursor):
         cursor.execute(
-            """CREATE TABLE "order"
+            """CREATE TABLE IF NOT EXISTS "order"
                (id INTEGER PRIMARY KEY, created INTEGER);""")
 
     @classmethod
     def get_latest(cls):
         return cls.get_where('created = (SELECT MAX(created) FROM "order")')
 
+    @classmethod
+    def get_pending(cls):
+        """
+        Orders that Gengo may still be queueing: we haven't seen any jobs
+        from them, nor seen them finish queueing without any we'd save
+        """
+        return cls.get_all_where(
+            'NOT resolved AND NOT EXISTS '
+            '(SELECT 1 FROM job WHERE job.order_id = "order".id)')
+
+    @classmethod
+    def resolve(cls, order_id):
+        """Record that Gengo has finished queueing order_id's jobs"""
+        with get_db():
+            execute('UPDATE "order" SET resolved = 1 WHERE id = ?;',
+                    (order_id,))
+
+
+class Catalog(Table):
+    _columns = ('path', 'mtime', 'size', 'hash', 'pending')
+    _table = 'catalog'
+
+    @classmethod
+    def create_table(cls, cursor):
+        # pending is a JSON list of the messages waiting for translations
+        cursor.execute(
+            """CREATE TABLE catalog (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL,
+                    size INTEGER,
+                    hash TEXT,
+                    pending TEXT
+                );""")
+
+
+class Review(Table):
+    _columns = ('job_id', 'message', 'thread', 'decision', 'comment')
+    _table = 'review'
+
+    @classmethod
+    def create_table(cls, cursor):
+        # Reviewable jobs that failed the automatic checks. message is the
+        # checks' complaint, and thread the job's comments, as JSON.
+        # decision is NULL until a reviewer makes one: 'approve' or
+        # 'revise', with comment.
+        cursor.execute(
+            """CREATE TABLE review (
+                    job_id INTEGER PRIMARY KEY REFERENCES job (id),
+                    message TEXT,
+                    thread TEXT,
+                    decision TEXT,
+                    comment TEXT
+                );""")
+
+    @classmethod
+    def get_queued_ids(cls):
+        return set(row[0] for row in select('SELECT job_id FROM review;'))
+
+    @classmethod
+    def get_undecided(cls):
+        return cls.get_all_where('decision IS NULL ORDER BY job_id')
+
+    @classmethod
+    def get_decided(cls):
+        return cls.get_all_where('decision IS NOT NULL ORDER BY job_id')
+
+    @classmethod
+    def prune(cls):
+        """Forget jobs that aren't reviewable any more"""
+        cls.delete_where("job_id NOT IN "
+                         "(SELECT id FROM job WHERE status = 'reviewable')")
+
+
+class Lease(Table):
+    _columns = ('name', 'owner', 'expires')
+    _table = 'lease'
+
+    @classmethod
+    def create_table(cls, cursor):
+        # A claim, by owner, on a unit of work that only one run should do
+        # at a time. Expired leases can be taken over.
+        cursor.execute(
+            """CREATE TABLE lease (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires REAL
+                );""")
+
+    @classmethod
+    def acquire(cls, name, owner, ttl, connection=None):
+        """
+        Take (or renew) the lease name for ttl seconds, unless someone else
+        holds it. Return whether we hold it, now.
+        Uses connection, if given, e.g. from another thread.
+        """
+        now = time.time()
+        connection = connection or get_db()
+        with connection:
+            connection.execute(
+                """INSERT INTO lease (name, owner, expires) VALUES (?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE
+                   SET owner = excluded.owner, expires = excluded.expires
+                   WHERE owner = excluded.owner OR expires < ?;""",
+                (name, owner, now + ttl, now))
+            row = connection.execute('SELECT owner FROM lease WHERE name = ?;',
+                                     (name,)).fetchone()
+        return row[0] == owner
+
+    @classmethod
+    def release(cls, name, owner):
+        cls.delete_where('name = ? AND owner = ?', (name, owner))
+
+
+class Outbox(Table):
+    _columns = ('key', 'job', 'created')
+    _table = 'outbox'
+
+    @classmethod
+    def create_table(cls, cursor):
+        # New jobs, as JSON, waiting for the run holding the order lease to
+        # post them. key identifies duplicates.
+        cursor.execute(
+            """CREATE TABLE outbox (
+                    key TEXT PRIMARY KEY,
+                    job TEXT,
+                    created REAL
+                );""")
+
+    @classmethod
+    def add(cls, rows):
+        """Queue rows, unless they're queued already"""
+        with get_db():
+            execute('INSERT OR IGNORE INTO outbox (key, job, created) '
+                    'VALUES (?, ?, ?);',
+                    (row._values() for row in rows), many=True)
+
+
+class Unconfirmed(Table):
+    _columns = ('key', 'job', 'created')
+    _table = 'unconfirmed'
+
+    @classmethod
+    def create_table(cls, cursor):
+        # Jobs, as JSON, from posts that failed after Gengo may have created
+        # their order. key identifies duplicates, as in the outbox.
+        cursor.execute(
+            """CREATE TABLE unconfirmed (
+                    key TEXT PRIMARY KEY,
+                    job TEXT,
+                    created REAL
+                );""")
+
+
+def create_tables(cursor):
+    Order.create_table(cursor)
+    Job.create_table(cursor)
+
+
+def add_scan_indexes(cursor):
+    # Partial, covering index for Job.get_in_progress. The WHERE clause has
+    # to match the query's, verbatim, for SQLite to use it.
+    cursor.execute(
+        """CREATE INDEX job_in_progress
+           ON job (id, order_id, lang, source, translation, status)
+           WHERE status NOT IN ('approved', 'canceled');""")
+    # For Order.get_latest
+    cursor.execute('CREATE INDEX order_created ON "order" (created);')
+
+
+def add_job_order_index(cursor):
+    # For Order.get_pending
+    cursor.execute('CREATE INDEX job_order ON job (order_id);')
+
+
+def add_order_resolved(cursor):
+    # Not one of Order's columns: saving an Order resets it, but only
+    # orders that we've seen jobs from are saved again
+    cursor.execute('ALTER TABLE "order" '
+                   'ADD COLUMN resolved INTEGER NOT NULL DEFAULT 0;')
+
+
+def intern_strings(cursor):
+    """
+    Move job sources and translations into a string table, keyed by
+    string_id, so that each text is stored and indexed once
+    """
+    cursor.execute(
+        """CREATE TABLE string (
+                id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL
+            );""")
+    for index in ('job_lang_string', 'job_status', 'job_in_progress',
+                  'job_order'):
+        cursor.execute('DROP INDEX %s;' % index)
+    cursor.execute(
+        """CREATE TABLE new_job (
+                id INTEGER PRIMARY KEY,
+                order_id INTEGER REFERENCES "order" (id),
+                lang TEXT,
+                source_id INTEGER REFERENCES string (id),
+                translation_id INTEGER REFERENCES string (id),
+                status TEXT
+            );""")
+
+    insert = cursor.connection.cursor()
+    for row in cursor.execute('SELECT id, order_id, lang, source, '
+                              'translation, status FROM job;'):
+        job = Job(*row)
+        insert.executemany(
+            'INSERT OR IGNORE INTO string (id, text) VALUES (?, ?);',
+            job._strings())
+        insert.execute('INSERT INTO new_job VALUES (?, ?, ?, ?, ?, ?);',
+                       job._replace_values())
+    cursor.execute('DROP TABLE job;')
+    cursor.execute('ALTER TABLE new_job RENAME TO job;')
+
+    cursor.execute('CREATE INDEX job_lang_string ON job (lang, source_id);')
+    cursor.execute('CREATE INDEX job_status ON job (status);')
+    cursor.execute(
+        """CREATE INDEX job_in_progress
+           ON job (id, order_id, lang, source_id, translation_id, status)
+           WHERE status NOT IN ('approved', 'canceled');""")
+    cursor.execute('CREATE INDEX job_order ON job (order_id);')
+    cursor.execute(
+        """CREATE VIEW job_text AS
+           SELECT job.id AS id, order_id, lang, source_id,
+                  source.text AS source, translation_id,
+                  translation.text AS translation, status
+           FROM job
+           LEFT JOIN string AS source ON source.id = source_id
+           LEFT JOIN string AS translation
+               ON translation.id = translation_id;""")
+
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have been applied. Only ever append to this list.
+MIGRATIONS = [
+    create_tables,
+    add_scan_indexes,
+    Catalog.create_table,
+    add_job_order_index,
+    Review.create_table,
+    intern_strings,
+    Lease.create_table,
+    Outbox.create_table,
+    Unconfirmed.create_table,
+    add_order_resolved,
+]
+
+
+def migrate(db):
+    """
+    Apply any MIGRATIONS that the database hasn't seen, yet.
+    Several processes may share the database, so they take the write lock
+    before checking the version, and migrate in a single transaction.
+    """
+    # Otherwise, sqlite3 would commit before every DDL statement
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute('BEGIN IMMEDIATE;')
+        try:
+            version = db.execute('PRAGMA user_version;').fetchone()[0]
+            for version, migration in enumerate(MIGRATIONS[version:],
+                                                version + 1):
+                c = db.cursor()
+                migration(c)
+                c.execute('PRAGMA user_version = %i;' % version)
+        except:
+            db.execute('ROLLBACK;')
+            raise
+        db.execute('COMMIT;')
+    finally:
+        db.isolation_level = isolation_level
+
+
+def execute(query, parameters=(), many=False):
+    """Execute query on the DB, reporting it to on_query. Return a cursor"""
+    db = get_db()
+    start = time.time()
+    if many:
+        c = db.executemany(query, parameters)
+    else:
+        c = db.execute(query, parameters)
+    if on_query:
+        on_query(query, time.time() - start)
+    return c
+
+
+def select(query, parameters=()):
+    """
+    Yield the rows of query. Report the time spent executing it and
+    fetching its rows, but not the caller's time between them, to on_query.
+    """
+    db = get_db()
+    start = time.time()
+    c = db.execute(query, parameters)
+    seconds = time.time() - start
+    try:
+        while True:
+            start = time.time()
+            rows = c.fetchmany(256)
+            seconds += time.time() - start
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        if on_query:
+            on_query(query, seconds)
+
+
+def connect(filename):
+    """A new connection to filename, with PRAGMAS applied"""
+    connection = sqlite3.connect(filename)
+    for pragma, value in PRAGMAS.iteritems():
+        connection.execute('PRAGMA %s = %s;' % (pragma, value))
+    return connection
+
 
 def get_db():
     global db, DB_NAME
     if not db:
-        create_tables = not os.path.exists(DB_NAME)
-        db = sqlite3.connect(DB_NAME)
-        if create_tables:
-            c = db.cursor()
-            Order.create_table(c)
-            Job.create_table(c)
-            db.commit()
+        db = connect(DB_NAME)
+        migrate(db)
     return db
@@ -0,0 +1,14 @@
+import unittest
+
+import orm
+
+
+class DBTestCase(unittest.TestCase):
+    def setUp(self):
+        orm.db = None
+        orm.DB_NAME = ':memory:'
+
+    def tearDown(self):
+        if orm.db:
+            orm.db.close()
+        orm.db = None
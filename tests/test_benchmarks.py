@@ -0,0 +1,28 @@
+import argparse
+import shutil
+import tempfile
+import unittest
+
+import gengogettext
+import orm
+from benchmarks import run
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        orm.db.close()
+        orm.db = None
+        gengogettext._gengo = None
+        shutil.rmtree(self.workdir)
+
+    def test_smoke(self):
+        args = argparse.Namespace(languages=2, messages=20, latency=0,
+                                  concurrency=2, jobs=1, seed=0)
+        phases = run.run(args, self.workdir)
+        results = dict((result['phase'], result)
+                       for result in phases.results)
+        self.assertGreater(results['sync: statuses']['api_requests'], 0)
+        self.assertIn('scan: json, unchanged', results)
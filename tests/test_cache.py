@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import Mock, patch
+
+from cache import CachingClient, ResponseCache
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'responses.db')
+        self.cache = ResponseCache(self.filename)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+
+class TestResponseCache(CacheTestCase):
+    def test_get(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.cache.set('foo', {'bar': [1]}, 60)
+        self.assertEqual(self.cache.get('foo'), {'bar': [1]})
+
+    def test_expiry(self):
+        self.cache.set('foo', 1, 60)
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get('foo'))
+
+    def test_persistent(self):
+        self.cache.set('foo', 1, 60)
+        self.cache.close()
+        self.cache = ResponseCache(self.filename)
+        self.assertEqual(self.cache.get('foo'), 1)
+
+    def test_evicts_least_recently_used(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.set(key, 1, 60)
+            time.sleep(0.01)
+        self.cache.get('a')
+        self.cache.close()
+        self.cache = ResponseCache(self.filename, max_entries=2)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 1)
+
+
+class TestCachingClient(CacheTestCase):
+    def setUp(self):
+        super(TestCachingClient, self).setUp()
+        self.gengo = Mock()
+        self.client = CachingClient(self.gengo, self.cache)
+
+    def test_comments(self):
+        self.gengo.getTranslationJobComments.return_value = {'thread': []}
+        for i in range(2):
+            self.assertEqual(self.client.getTranslationJobComments(id=1),
+                             {'thread': []})
+        self.gengo.getTranslationJobComments.assert_called_once_with(id=1)
+
+    def test_quotes_by_jobs(self):
+        self.gengo.determineTranslationCost.return_value = {'jobs': []}
+        self.client.determineTranslationCost(jobs={0: {'body_src': 'a'}})
+        self.client.determineTranslationCost(jobs={0: {'body_src': 'b'}})
+        self.client.determineTranslationCost(jobs={0: {'body_src': 'a'}})
+        self.assertEqual(self.gengo.determineTranslationCost.call_count, 2)
+
+    def test_not_cached(self):
+        self.client.getTranslationJobs(count=10)
+        self.client.getTranslationJobs(count=10)
+        self.assertEqual(self.gengo.getTranslationJobs.call_count, 2)
+
+    def test_only_final_jobs(self):
+        statuses = {'1': 'approved', '2': 'reviewable'}
+        self.gengo.getTranslationJobBatch.side_effect = lambda id: {
+            'response': {'jobs': [
+                {'job_id': job_id, 'status': statuses[job_id]}
+                for job_id in id.split(',')]}}
+        self.client.getTranslationJobBatch(id='1,2')
+        r = self.client.getTranslationJobBatch(id='2,1')
+        self.gengo.getTranslationJobBatch.assert_called_with(id='2')
+        self.assertEqual(
+            sorted(job['job_id'] for job in r['response']['jobs']),
+            ['1', '2'])
+        r = self.client.getTranslationJobBatch(id='1')
+        self.assertEqual(self.gengo.getTranslationJobBatch.call_count, 2)
+        self.assertEqual(r['response']['jobs'],
+                         [{'job_id': '1', 'status': 'approved'}])
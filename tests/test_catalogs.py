@@ -0,0 +1,210 @@
+# coding: UTF-8
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import polib
+
+from catalogs import AtomicFile, scan_po, write_json, write_mo, write_po
+
+PO = u'''# French translations
+# Copyright
+#, fuzzy
+msgid ""
+msgstr ""
+"Project-Id-Version: test\\n"
+"Content-Type: text/plain; charset=UTF-8\\n"
+
+#: page.html:1
+msgid "Hello"
+msgstr "Bonjour"
+
+#, fuzzy
+msgid "LONG"
+msgstr "Un long message"
+
+msgctxt "menu"
+msgid "Hello"
+msgstr ""
+"Bonjour, "
+"\\"le\\" \\\\ monde\\n"
+
+msgid "One file"
+msgid_plural "%d files"
+msgstr[0] "Un fichier"
+msgstr[1] "%d fichiers"
+
+#~ msgid "Old"
+#~ msgstr "Très vieux"
+'''.replace('LONG', u'A long message, longer than the wrap width. ' * 3)
+
+
+class CatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'catalog')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+
+class TestAtomicFile(CatalogTestCase):
+    def test_new_file(self):
+        with AtomicFile(self.filename) as f:
+            f.write(b'foo')
+        self.assertTrue(f.changed)
+        self.assertEqual(self.read(), b'foo')
+        self.assertEqual(os.listdir(self.dir), ['catalog'])
+
+    def test_identical_file_is_left_alone(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'foobar')
+        os.utime(self.filename, (1000, 1000))
+        with AtomicFile(self.filename) as f:
+            f.write(b'foo')
+            f.write(b'bar')
+        self.assertFalse(f.changed)
+        self.assertEqual(os.stat(self.filename).st_mtime, 1000)
+        self.assertEqual(os.listdir(self.dir), ['catalog'])
+
+    def test_prefix_is_a_change(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'foobar')
+        with AtomicFile(self.filename) as f:
+            f.write(b'foo')
+        self.assertTrue(f.changed)
+        self.assertEqual(self.read(), b'foo')
+
+    def test_keeps_permissions(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'foo')
+        os.chmod(self.filename, 0o640)
+        with AtomicFile(self.filename) as f:
+            f.write(b'bar')
+        self.assertEqual(os.stat(self.filename).st_mode & 0o777, 0o640)
+
+    def test_error_leaves_file(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b'foo')
+        with self.assertRaises(ValueError):
+            with AtomicFile(self.filename) as f:
+                f.write(b'bar')
+                raise ValueError()
+        self.assertEqual(self.read(), b'foo')
+        self.assertEqual(os.listdir(self.dir), ['catalog'])
+
+
+class TestWritePO(CatalogTestCase):
+    def setUp(self):
+        super(TestWritePO, self).setUp()
+        with io.open(self.filename, 'w', encoding='utf-8') as f:
+            f.write(PO)
+        self.po = polib.pofile(self.filename)
+
+    def test_same_as_polib(self):
+        self.po[0].msgstr = u'Salut'
+        self.assertTrue(write_po(self.po))
+        expected = os.path.join(self.dir, 'expected')
+        self.po.save(expected)
+        with open(expected, 'rb') as f:
+            self.assertEqual(self.read(), f.read())
+
+    def test_unchanged(self):
+        self.po.save()
+        self.assertFalse(write_po(self.po))
+
+
+class TestWriteMO(CatalogTestCase):
+    def test_same_as_polib(self):
+        with io.open(self.filename, 'w', encoding='utf-8') as f:
+            f.write(PO)
+        po = polib.pofile(self.filename)
+        mo_filename = os.path.join(self.dir, 'catalog.mo')
+        self.assertTrue(write_mo(po, mo_filename))
+        self.assertFalse(write_mo(po, mo_filename))
+        mo = polib.mofile(mo_filename)
+        self.assertEqual([(entry.msgctxt, entry.msgid) for entry in mo],
+                         [(None, u'Hello'), (None, u'One file'),
+                          (u'menu', u'Hello')])
+
+
+class TestWriteJSON(CatalogTestCase):
+    def test_same_as_dumps(self):
+        data = {u'Hello': u'Bonjour', u'Bye': u'À bientôt'}
+        self.assertTrue(write_json(self.filename, data))
+        self.assertEqual(
+            self.read().decode('utf-8'),
+            json.dumps(data, sort_keys=True, indent=2, ensure_ascii=False,
+                       separators=(',', ': ')))
+        self.assertFalse(write_json(self.filename, data))
+
+    def test_minify(self):
+        data = {u'Hello': u'Bonjour', u'Bye': u'À bientôt'}
+        self.assertTrue(write_json(self.filename, data, minify=True))
+        self.assertEqual(self.read().decode('utf-8'),
+                         u'{"Bye":"À bientôt","Hello":"Bonjour"}')
+
+
+class TestScanPO(CatalogTestCase):
+    def write(self, contents):
+        with io.open(self.filename, 'w', encoding='utf-8') as f:
+            f.write(contents)
+
+    def scan(self):
+        return [(entry.msgctxt, entry.msgid, entry.msgid_plural,
+                 entry.msgstr, entry.flags, entry.obsolete)
+                for entry in scan_po(self.filename)]
+
+    def test_same_as_polib(self):
+        self.write(PO)
+        self.assertEqual(
+            self.scan(),
+            [(entry.msgctxt, entry.msgid, entry.msgid_plural, entry.msgstr,
+              entry.flags, bool(entry.obsolete))
+             for entry in polib.pofile(self.filename)])
+
+    def test_fields(self):
+        self.write(PO)
+        entries = list(scan_po(self.filename))
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(entries[0].msgstr, u'Bonjour')
+        self.assertEqual(entries[1].flags, [u'fuzzy'])
+        self.assertEqual(entries[2].msgctxt, u'menu')
+        self.assertEqual(entries[2].msgstr, u'Bonjour, "le" \\ monde\n')
+        self.assertEqual(entries[3].msgid_plural, u'%d files')
+        self.assertTrue(entries[4].obsolete)
+        self.assertEqual(entries[4].msgstr, u'Tr\xe8s vieux')
+
+    def test_no_header(self):
+        self.write(u'msgid "Hello"\nmsgstr ""\n\n'
+                   u'#, fuzzy\nmsgid "Bye"\nmsgstr "Salut"\n')
+        self.assertEqual(self.scan(), [
+            (None, u'Hello', u'', u'', [], False),
+            (None, u'Bye', u'', u'Salut', [u'fuzzy'], False),
+        ])
+
+    def test_latin1(self):
+        with open(self.filename, 'wb') as f:
+            f.write(PO.replace(u'UTF-8', u'ISO-8859-1').encode('latin-1'))
+        entries = list(scan_po(self.filename))
+        self.assertEqual(entries[4].msgstr, u'Tr\xe8s vieux')
+
+    def test_unknown_charset(self):
+        # As in a new catalog, from a template
+        self.write(PO.replace(u'UTF-8', u'CHARSET'))
+        entries = list(scan_po(self.filename))
+        self.assertEqual(entries[4].msgstr, u'Tr\xe8s vieux')
+
+    def test_flags_without_a_space(self):
+        self.write(u'#,fuzzy, python-format\nmsgid "Hello %s"\nmsgstr ""\n')
+        self.assertEqual(self.scan(), [
+            (None, u'Hello %s', u'', u'', [u'fuzzy', u'python-format'],
+             False),
+        ])
@@ -1,13 +1,33 @@
 # coding: utf-8
+import argparse
 import collections
 import contextlib
 import errno
+import itertools
+import json
 import os
+import Queue
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import urllib
+import urllib2
 
-from mock import patch
+import polib
+import requests
+from gengo import GengoError
+from mock import ANY, Mock, patch
 
+import callbacks
 import gengogettext
+import orm
+from orm import Catalog, Job, Lease, Order, Outbox, Review, Unconfirmed
+from tests import DBTestCase
 
 
 @contextlib.contextmanager
@@ -25,14 +45,21 @@ class TestGengoGettext(unittest.TestCase):
         self.args = {
             'config': 'tests/projects.ini',
             'verbose': True,
-            'database': self.db_name
+            'database': self.db_name,
+            'cache': None,
         }
-        with ignoring(OSError, errno.ENOENT):
-            os.remove(self.db_name)
+        orm.db = None
+        for suffix in ('', '-wal', '-shm'):
+            with ignoring(OSError, errno.ENOENT):
+                os.remove(self.db_name + suffix)
 
     def tearDown(self):
-        with ignoring(OSError, errno.ENOENT):
-            os.remove(self.db_name)
+        if orm.db:
+            orm.db.close()
+        orm.db = None
+        for suffix in ('', '-wal', '-shm'):
+            with ignoring(OSError, errno.ENOENT):
+                os.remove(self.db_name + suffix)
 
     @patch('requests.api.request')
     def test_only_updates_jobs(self, request):
@@ -42,6 +69,528 @@ class TestGengoGettext(unittest.TestCase):
         self.assertIn('translate/jobs/', called_url)
 
 
+class TestCommands(unittest.TestCase):
+    def test_threshold(self):
+        self.assertEqual(gengogettext.threshold('0'), 0)
+        self.assertEqual(gengogettext.threshold('0.8'), 0.8)
+        for value in ('1.5', '-1', 'nan'):
+            self.assertRaises(argparse.ArgumentTypeError,
+                              gengogettext.threshold, value)
+
+    def test_lazy_imports(self):
+        modules = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, gengogettext; print " ".join(sys.modules)']).split()
+        for module in ('gengo', 'requests', 'polib', 'yoconfigurator'):
+            self.assertNotIn(module, modules)
+
+    @patch('gengogettext.order')
+    @patch('gengogettext.scan')
+    @patch('gengogettext.review')
+    @patch('gengogettext.sync')
+    def run_command(self, command, sync, review, scan, order):
+        gengogettext.run(None, [], Mock(command=command))
+        return [name for name, step in (('sync', sync), ('review', review),
+                                        ('scan', scan), ('order', order))
+                if step.called]
+
+    def test_commands(self):
+        self.assertEqual(self.run_command('all'),
+                         ['sync', 'review', 'scan', 'order'])
+        self.assertEqual(self.run_command('sync'), ['sync'])
+        self.assertEqual(self.run_command('review'), ['review'])
+        self.assertEqual(self.run_command('scan'), ['scan'])
+
+    def test_order_syncs_first(self):
+        self.assertEqual(self.run_command('order'),
+                         ['sync', 'scan', 'order'])
+
+    @patch('gengogettext.scan')
+    @patch('gengogettext.update_statuses')
+    @patch('gengogettext.update_db')
+    @patch('gengogettext.resume_orders', return_value=True)
+    def test_order_knows_resumed_jobs_before_scanning(
+            self, resume_orders, update_db, update_statuses, scan):
+        steps = Mock()
+        steps.attach_mock(resume_orders, 'resume_orders')
+        steps.attach_mock(update_statuses, 'update_statuses')
+        steps.attach_mock(scan, 'scan')
+        with patch('gengogettext.order'):
+            gengogettext.run(None, [], Mock(command='order'))
+        self.assertEqual([name for name, args, kwargs in steps.method_calls],
+                         ['resume_orders', 'update_statuses', 'scan'])
+
+
+class TestJobIndex(DBTestCase):
+    def setUp(self):
+        super(TestJobIndex, self).setUp()
+        Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved').save()
+        Job(2, 1, 'fr', 'Bye', '', 'available').save()
+        Job(3, 1, 'de', 'Hello', 'Hallo', 'approved').save()
+        self.locale_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestJobIndex, self).tearDown()
+        shutil.rmtree(self.locale_dir)
+
+    def test_index_is_per_language(self):
+        index = Job.get_index('fr')
+        self.assertEqual(sorted(index), ['Bye', 'Hello'])
+        self.assertEqual(index['Hello'].translation, 'Bonjour')
+
+    def walk_json_file(self):
+        source = {'Hello': 'Hello', 'Bye': 'Bye', 'Later': 'Later'}
+        with open(os.path.join(self.locale_dir, 'en.json'), 'w') as f:
+            json.dump(source, f)
+        return list(gengogettext.walk_json_file(
+            source, 'fr', self.locale_dir, False, Job.get_index('fr')))
+
+    def test_walk_json_file(self):
+        jobs = self.walk_json_file()
+        self.assertEqual([job['body_src'] for job in jobs], ['Later'])
+        with open(os.path.join(self.locale_dir, 'fr.json')) as f:
+            self.assertEqual(json.load(f), {'Hello': 'Bonjour'})
+
+    def test_walk_unchanged_json_file(self):
+        self.walk_json_file()
+        with patch('gengogettext.open_or_create_json_file') as open_json:
+            jobs = self.walk_json_file()
+            self.assertFalse(open_json.called)
+        self.assertEqual([job['body_src'] for job in jobs], ['Later'])
+
+
+class POTestCase(DBTestCase):
+    def setUp(self):
+        super(POTestCase, self).setUp()
+        self.locale_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.locale_dir, 'fr', 'LC_MESSAGES'))
+        self.filename = gengogettext.po_file(self.locale_dir, 'fr', 'messages')
+        with open(self.filename, 'w') as f:
+            f.write('msgid "Hello"\nmsgstr ""\n\n'
+                    '#, fuzzy\nmsgid "Bye"\nmsgstr "Salut"\n')
+
+    def tearDown(self):
+        super(POTestCase, self).tearDown()
+        shutil.rmtree(self.locale_dir)
+
+    def walk(self):
+        return list(gengogettext.walk_po_file(
+            self.locale_dir, 'fr', 'messages', False, Job.get_index('fr')))
+
+
+class TestCatalogCache(POTestCase):
+
+    def test_unchanged_file_is_not_parsed(self):
+        jobs = self.walk()
+        with patch('polib.pofile') as pofile, \
+                patch('gengogettext.scan_po') as scan_po:
+            self.assertEqual(self.walk(), jobs)
+            self.assertFalse(pofile.called)
+            self.assertFalse(scan_po.called)
+        self.assertEqual([job['body_src'] for job in jobs], ['Hello', 'Bye'])
+        self.assertIn('Salut', jobs[1]['comment'])
+
+    def test_ordered_messages(self):
+        self.walk()
+        Job(1, 1, 'fr', 'Hello', '', 'available').save()
+        jobs = self.walk()
+        self.assertEqual([job['body_src'] for job in jobs], ['Bye'])
+
+    def test_unchanged_file_is_not_rewritten(self):
+        os.utime(self.filename, (1000, 1000))
+        with patch('polib.pofile') as pofile:
+            self.walk()
+            self.assertFalse(pofile.called)
+        self.assertEqual(os.stat(self.filename).st_mtime, 1000)
+
+    def test_approved_messages_are_merged(self):
+        self.walk()
+        Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved').save()
+        self.walk()
+        with open(self.filename) as f:
+            self.assertIn('msgstr "Bonjour"', f.read())
+
+    def test_modified_file_is_parsed(self):
+        self.walk()
+        with open(self.filename, 'a') as f:
+            f.write('\nmsgid "Later"\nmsgstr ""\n')
+        jobs = self.walk()
+        self.assertEqual([job['body_src'] for job in jobs],
+                         ['Hello', 'Bye', 'Later'])
+
+
+@patch('gengogettext.COMPILE', True)
+class TestCompile(POTestCase):
+    def setUp(self):
+        super(TestCompile, self).setUp()
+        self.mo_filename = self.filename[:-3] + '.mo'
+
+    def test_compiles_mo(self):
+        Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved').save()
+        self.walk()
+        mo = polib.mofile(self.mo_filename)
+        # Fuzzy translations are left out
+        self.assertEqual([(entry.msgid, entry.msgstr) for entry in mo],
+                         [(u'Hello', u'Bonjour')])
+
+    def test_up_to_date_mo_is_left_alone(self):
+        self.walk()
+        os.utime(self.mo_filename, (2000000000, 2000000000))
+        with patch('gengogettext.write_mo') as write_mo:
+            self.walk()
+            self.assertFalse(write_mo.called)
+
+    def test_stale_mo_is_recompiled(self):
+        os.utime(self.filename, (2000, 2000))
+        self.walk()
+        os.utime(self.mo_filename, (1000, 1000))
+        self.walk()
+        # Identical, so only its mtime changes
+        self.assertGreater(os.stat(self.mo_filename).st_mtime, 2000)
+
+    def test_minifies_json(self):
+        with open(os.path.join(self.locale_dir, 'en.json'), 'w') as f:
+            json.dump({'Hello': 'Hello', 'Bye': 'Bye'}, f)
+        Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved').save()
+        list(gengogettext.walk_json_file(None, 'fr', self.locale_dir,
+                                         False))
+        with open(os.path.join(self.locale_dir, 'fr.min.json')) as f:
+            self.assertEqual(f.read(), '{"Hello":"Bonjour"}')
+
+
+@patch('gengogettext.gengo')
+class TestApiMap(unittest.TestCase):
+    def test_results_are_ordered(self, gengo):
+        def slow_double(n):
+            time.sleep((10 - n) / 1000.0)
+            return n * 2
+        results = gengogettext.api_map(slow_double, range(10))
+        self.assertEqual(list(results), [n * 2 for n in range(10)])
+
+    def test_empty(self, gengo):
+        self.assertEqual(list(gengogettext.api_map(str, [])), [])
+        self.assertFalse(gengo.called)
+
+    @patch('gengogettext.RATE_LIMIT', 100)
+    def test_rate_limit(self, gengo):
+        start = time.time()
+        list(gengogettext.api_map(str, range(10)))
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+
+class TestParallelWalk(POTestCase):
+    def walks(self):
+        return [('fr', self.filename, gengogettext.walk_po_file,
+                 (self.locale_dir, 'fr', 'messages', False))]
+
+    def test_same_jobs(self):
+        Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved').save()
+        jobs = gengogettext.walk_catalogs_in_parallel(self.walks(), 2)
+        self.assertEqual([job['body_src'] for job in jobs], ['Bye'])
+        with open(self.filename) as f:
+            self.assertIn('msgstr "Bonjour"', f.read())
+
+    def test_parent_records_catalogs(self):
+        gengogettext.walk_catalogs_in_parallel(self.walks(), 2)
+        catalog = Catalog.get_where('path = ?', (self.filename,))
+        self.assertEqual(json.loads(catalog.pending),
+                         [['Hello', ''], ['Bye', 'Salut']])
+
+    @patch('gengogettext._inherited_dbs', [])
+    def test_workers_dont_close_the_parents_connection(self):
+        with patch('orm.db', Mock()) as inherited:
+            gengogettext.init_walk_worker()
+            self.assertIsNone(orm.db)
+        self.assertEqual(gengogettext._inherited_dbs, [inherited])
+        self.assertFalse(inherited.close.called)
+
+
+@patch('gengogettext.TRANSLATION_MEMORY', 1)
+class TestTranslationMemoryWalk(POTestCase):
+    def walk(self):
+        return gengogettext.walk_catalogs(
+            [('fr', self.filename, gengogettext.walk_po_file,
+              (self.locale_dir, 'fr', 'messages', False))])
+
+    def test_suggestion_instead_of_job(self):
+        Job(1, 1, 'fr', 'hello ', 'Bonjour', 'approved').save()
+        jobs = self.walk()
+        self.assertEqual([job['body_src'] for job in jobs], ['Bye'])
+        with open(self.filename) as f:
+            self.assertIn('#, fuzzy\nmsgid "Hello"\nmsgstr "Bonjour"',
+                          f.read())
+        self.assertEqual([job['body_src'] for job in self.walk()], ['Bye'])
+
+    def test_no_suggestion(self):
+        jobs = self.walk()
+        self.assertEqual([job['body_src'] for job in jobs], ['Hello', 'Bye'])
+
+    def test_cached_catalog_gets_new_suggestions(self):
+        self.walk()
+        Job(1, 1, 'fr', 'HELLO', 'Bonjour', 'approved').save()
+        self.assertEqual([job['body_src'] for job in self.walk()], ['Bye'])
+
+    def test_translated_messages_are_remembered(self):
+        other = gengogettext.po_file(self.locale_dir, 'fr', 'other')
+        with open(other, 'w') as f:
+            f.write('msgid "bye"\nmsgstr "Au revoir"\n')
+        jobs = gengogettext.walk_catalogs(
+            [('fr', other, gengogettext.walk_po_file,
+              (self.locale_dir, 'fr', 'other', False)),
+             ('fr', self.filename, gengogettext.walk_po_file,
+              (self.locale_dir, 'fr', 'messages', False))])
+        self.assertEqual([job['body_src'] for job in jobs], ['Hello'])
+        with open(self.filename) as f:
+            self.assertIn('msgstr "Au revoir"', f.read())
+
+
+@patch('gengogettext.CONCURRENCY', 1)
+@patch('gengogettext.JOB_PAGE_SIZE', 3)
+@patch('gengogettext.gengo')
+class TestUpdateDB(DBTestCase):
+    # Order 1 has jobs 1-3, order 2 has 4 and 5
+    orders = {1: [1, 2, 3], 2: [4, 5]}
+
+    def job_data(self, id):
+        return {
+            'job_id': str(id),
+            'order_id': '1' if id <= 3 else '2',
+            'ctime': 1000 + id,
+            'lc_tgt': 'fr',
+            'body_src': 'source %i' % id,
+            'status': 'available',
+        }
+
+    def respond(self, gengo):
+        # Like Gengo, list the newest jobs first
+        gengo().getTranslationJobs.side_effect = lambda count, **kwargs: {
+            'response': [{'job_id': str(id), 'ctime': 1000 + id}
+                         for id in range(5, 0, -1)][:count]}
+        gengo().getTranslationJobBatch.side_effect = lambda id: {
+            'response': {'jobs': [self.job_data(int(job_id))
+                                  for job_id in id.split(',')]}}
+        gengo().getTranslationOrderJobs.side_effect = lambda id: {
+            'response': {'order': {
+                'jobs_available': [str(job_id)
+                                   for job_id in self.orders[id]]}}}
+
+    def test_fetches_unlisted_jobs_of_listed_orders(self, gengo):
+        self.respond(gengo)
+        Job(4, 2, 'fr', 'known', '', 'available').save()
+
+        gengogettext.update_db()
+
+        requested = [call[1]['id'] for call in
+                     gengo().getTranslationJobBatch.call_args_list]
+        self.assertEqual(requested, ['3,5', '1,2'])
+        self.assertEqual(Job.get_known_ids(range(10)),
+                         set([1, 2, 3, 4, 5]))
+        self.assertEqual(Job.get_where('id = 4').source, 'known')
+        self.assertEqual(Order.get_latest().created, 1005)
+
+    def test_since_latest_order(self, gengo):
+        self.respond(gengo)
+        Order(2, 1003).save()
+        gengogettext.update_db()
+        self.assertEqual(gengo().getTranslationJobs.call_args[1],
+                         {'count': 3, 'timestamp_after': 1003})
+
+
+@patch('time.sleep')
+@patch('gengogettext.gengo')
+class TestOrders(DBTestCase):
+    def order(self, *queued):
+        return [{'response': {'order': {
+            'jobs_queued': str(n),
+            'jobs_available': ['1', '2'] if n == 0 else [],
+            'jobs_approved': [],
+        }}} for n in queued]
+
+    @patch('random.uniform', lambda a, b: 1)
+    def test_wait_for_order(self, gengo, sleep):
+        gengo().getTranslationOrderJobs.side_effect = self.order(3, 2, 1, 0)
+        order = gengogettext.wait_for_order(1, 60)
+        self.assertEqual(order['jobs_available'], ['1', '2'])
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [1, 2, 4])
+
+    def test_wait_for_order_times_out(self, gengo, sleep):
+        gengo().getTranslationOrderJobs.side_effect = self.order(1)
+        self.assertIsNone(gengogettext.wait_for_order(1, 0))
+        self.assertFalse(sleep.called)
+
+    def test_resume_orders(self, gengo, sleep):
+        Order(1, 1000).save()
+        Order(2, 1000).save()
+        Job(3, 2, 'fr', 'Hello', '', 'available').save()
+        self.assertEqual([order.id for order in Order.get_pending()], [1])
+
+        gengo().getTranslationOrderJobs.side_effect = self.order(1)
+        self.assertFalse(gengogettext.resume_orders())
+
+        gengo().getTranslationOrderJobs.side_effect = self.order(0)
+        self.assertTrue(gengogettext.resume_orders())
+        self.assertEqual(Job.get_known_ids([1, 2, 3]), set([1, 2, 3]))
+        self.assertEqual(list(Order.get_pending()), [])
+
+    def test_resume_order_without_jobs_to_save(self, gengo, sleep):
+        # e.g. every job was cancelled
+        Order(1, 1000).save()
+        gengo().getTranslationOrderJobs.return_value = {'response': {
+            'order': {'jobs_queued': '0', 'jobs_available': [],
+                      'jobs_approved': [], 'jobs_cancelled': ['1']}}}
+        self.assertTrue(gengogettext.resume_orders())
+        self.assertEqual(list(Order.get_pending()), [])
+
+
+@patch('gengogettext.BATCH_SIZE', 2)
+@patch('gengogettext.update_statuses')
+@patch('gengogettext.gengo')
+class TestBatchedOrders(DBTestCase):
+    jobs = [{'body_src': 'message %i' % i, 'lc_tgt': 'fr'} for i in range(5)]
+
+    def test_quote(self, gengo, update_statuses):
+        gengo().determineTranslationCost.side_effect = lambda jobs: {
+            'response': {'jobs': [{'currency': 'USD', 'credits': '1.5'}
+                                  for job in jobs]}}
+        self.assertEqual(gengogettext.quote_jobs(self.jobs), 7.5)
+        self.assertEqual(gengo().determineTranslationCost.call_count, 3)
+
+    def test_post_retries_failed_batches(self, gengo, update_statuses):
+        order_ids = itertools.count(1)
+        failed = []
+
+        def post(jobs):
+            if jobs[0]['body_src'] == 'message 2' and not failed:
+                failed.append(jobs)
+                raise GengoError('Try again')
+            return {'response': {'order_id': next(order_ids)}}
+
+        gengo().postTranslationJobs.side_effect = post
+        gengo().getTranslationOrderJobs.side_effect = lambda id: {
+            'response': {'order': {'jobs_queued': '0',
+                                   'jobs_available': [str(id * 10)],
+                                   'jobs_approved': []}}}
+        gengogettext.post_jobs(self.jobs)
+
+        self.assertEqual(gengo().postTranslationJobs.call_count, 4)
+        self.assertEqual(len(list(Order.get_all_where('1'))), 3)
+        self.assertEqual(len(Job.get_known_ids([10, 20, 30, 40])), 3)
+        self.assertTrue(update_statuses.called)
+
+    @patch('gengogettext.CONCURRENCY', 1)
+    def test_post_only_retries_certain_failures(self, gengo,
+                                                update_statuses):
+        errors = {
+            'message 0': requests.ConnectionError(
+                socket.error(errno.ECONNREFUSED, 'Connection refused')),
+            'message 2': requests.Timeout('Read timed out'),
+        }
+
+        def post(jobs):
+            error = errors.pop(jobs[0]['body_src'], None)
+            if error:
+                raise error
+            return {'response': {'order_id': 1}}
+
+        gengo().postTranslationJobs.side_effect = post
+        gengo().getTranslationOrderJobs.return_value = {
+            'response': {'order': {'jobs_queued': '0',
+                                   'jobs_available': [],
+                                   'jobs_approved': []}}}
+        self.assertEqual(gengogettext.post_jobs(self.jobs), [])
+        posted = [call[1]['jobs'][0]['body_src'] for call in
+                  gengo().postTranslationJobs.call_args_list]
+        self.assertEqual(posted,
+                         ['message 0', 'message 2', 'message 4',
+                          'message 0'])
+        self.assertEqual(sorted(json.loads(entry.job)['body_src'] for entry
+                                in Unconfirmed.get_all_where('1')),
+                         ['message 2', 'message 3'])
+
+    @patch('gengogettext.post_jobs', side_effect=lambda jobs, posted: [])
+    @patch('gengogettext.quote_jobs', return_value=0)
+    @patch('__builtin__.raw_input')
+    def test_order_holds_unconfirmed_jobs(self, raw_input, quote_jobs,
+                                          post_jobs, gengo, update_statuses):
+        Unconfirmed(json.dumps(gengogettext.job_key(self.jobs[1])),
+                    json.dumps(self.jobs[1]), 1000).save()
+        self.assertEqual(gengogettext.order(self.jobs[:3], True),
+                         [self.jobs[1]])
+        post_jobs.assert_called_once_with([self.jobs[0], self.jobs[2]], None)
+
+    @patch('gengogettext.LOST_LEASES', set(['order']))
+    def test_post_stops_when_the_order_lease_is_lost(self, gengo,
+                                                     update_statuses):
+        self.assertEqual(gengogettext.post_jobs(self.jobs), self.jobs)
+        self.assertFalse(gengo().postTranslationJobs.called)
+
+    def test_order_not_created(self, gengo, update_statuses):
+        self.assertTrue(gengogettext.order_not_created(GengoError('No')))
+        self.assertTrue(gengogettext.order_not_created(
+            requests.ConnectionError(socket.gaierror(-2, 'Unknown host'))))
+        self.assertFalse(gengogettext.order_not_created(
+            requests.ConnectionError(
+                socket.error(errno.ECONNRESET, 'Connection reset'))))
+        self.assertFalse(gengogettext.order_not_created(
+            requests.Timeout('Read timed out')))
+
+
+@patch('gengogettext.JOB_PAGE_SIZE', 2)
+@patch('gengogettext.gengo')
+class TestConfirmPosts(DBTestCase):
+    def setUp(self):
+        super(TestConfirmPosts, self).setUp()
+        for message in (u'Hello', u'Bye'):
+            job = gengogettext.get_job_data(message, 'fr', False)
+            Unconfirmed(json.dumps(gengogettext.job_key(job)),
+                        json.dumps(job), 1000).save()
+
+    def respond(self, gengo, job_ids):
+        gengo().getTranslationJobs.return_value = {'response': [
+            {'job_id': str(job_id)} for job_id in job_ids]}
+        gengo().getTranslationJobBatch.side_effect = lambda id: {
+            'response': {'jobs': [
+                {'job_id': '7', 'order_id': '3', 'ctime': 1001,
+                 'status': 'available', 'body_src': u'Hello',
+                 'lc_tgt': 'fr'}]}}
+
+    def unconfirmed(self):
+        return [json.loads(entry.job)['body_src']
+                for entry in Unconfirmed.get_all_where('1')]
+
+    def test_nothing_to_confirm(self, gengo):
+        Unconfirmed.delete_where('1')
+        self.assertTrue(gengogettext.confirm_posts())
+        self.assertFalse(gengo().getTranslationJobs.called)
+
+    def test_complete_listing(self, gengo):
+        self.respond(gengo, [7])
+        self.assertTrue(gengogettext.confirm_posts())
+        gengo().getTranslationJobs.assert_called_once_with(
+            count=2, timestamp_after=1000)
+        self.assertEqual(Job.find('fr', u'Hello').order_id, 3)
+        self.assertEqual(self.unconfirmed(), [])
+
+    def test_full_listing_only_confirms_found_orders(self, gengo):
+        self.respond(gengo, [7, 8])
+        self.assertFalse(gengogettext.confirm_posts())
+        self.assertEqual(self.unconfirmed(), [u'Bye'])
+
+
+class TestDedupeJobs(unittest.TestCase):
+    def test_dedupe(self):
+        jobs = [
+            gengogettext.get_job_data('Save', 'fr', False),
+            gengogettext.get_job_data('Save', 'de', False),
+            gengogettext.get_job_data('Save', 'fr', True),
+            gengogettext.get_job_data('Save', 'fr', False, 'Sauver'),
+            gengogettext.get_job_data('Cancel', 'fr', False),
+        ]
+        self.assertEqual(gengogettext.dedupe_jobs(jobs),
+                         [jobs[0], jobs[1], jobs[2], jobs[4]])
+
+
 class TestTranslationChecks(unittest.TestCase):
 
     def check_translation(self, source, translation):
@@ -138,6 +687,357 @@ class TestTranslationChecks(unittest.TestCase):
             'Casa &amp； Giardino'))
 
 
+@patch('gengogettext.gengo')
+class TestUpdateStatuses(DBTestCase):
+    def setUp(self):
+        super(TestUpdateStatuses, self).setUp()
+        Job.save_many([Job(1, 1, 'fr', u'Hello', u'', 'available'),
+                       Job(2, 1, 'de', u'Hello', u'', 'available')])
+
+    def respond(self, gengo, status):
+        gengo().getTranslationJobBatch.side_effect = lambda id: {
+            'response': {'jobs': [
+                {'job_id': job_id, 'status': status, 'body_src': u'Hello',
+                 'body_tgt': u'Hi', 'lc_tgt': 'fr'}
+                for job_id in id.split(',')]}}
+
+    def test_returns_approved(self, gengo):
+        self.respond(gengo, 'approved')
+        approved = gengogettext.update_statuses()
+        self.assertEqual(sorted(job.id for job in approved), [1, 2])
+        self.assertEqual(Job.get_where('id = 1').status, 'approved')
+
+    def test_only_job_ids(self, gengo):
+        self.respond(gengo, 'reviewable')
+        self.assertEqual(gengogettext.update_statuses(set([2])), [])
+        gengo().getTranslationJobBatch.assert_called_once_with(id='2')
+
+    def test_only_lang(self, gengo):
+        self.respond(gengo, 'reviewable')
+        gengogettext.update_statuses(lang='de')
+        gengo().getTranslationJobBatch.assert_called_once_with(id='2')
+
+
+@patch('gengogettext.lease_owner', return_value='here:1')
+class TestSharedRun(DBTestCase):
+    def test_leased(self, lease_owner):
+        Lease.acquire('scan:a:fr', 'there:2', 60)
+        with gengogettext.leased('scan:a:fr') as acquired:
+            self.assertFalse(acquired)
+        with gengogettext.leased('scan:a:de') as acquired:
+            self.assertTrue(acquired)
+        self.assertIsNone(Lease.get_where("name = 'scan:a:de'"))
+
+    def test_failure_keeps_lease(self, lease_owner):
+        with self.assertRaises(ValueError):
+            with gengogettext.leased('order'):
+                raise ValueError()
+        self.assertEqual(Lease.get_where("name = 'order'").owner, 'here:1')
+
+    @patch('gengogettext.walk_catalogs')
+    @patch('gengogettext.get_catalog_walks')
+    def test_scans_unclaimed_shards(self, get_catalog_walks, walk_catalogs,
+                                    lease_owner):
+        get_catalog_walks.side_effect = lambda config, projects, languages: [
+            ('fr', 'fr.po', None, ()),
+            ('de', 'de.po', None, ()),
+        ]
+        walk_catalogs.side_effect = lambda walks: [
+            gengogettext.get_job_data(u'Hello', walks[0][0], False)]
+        Lease.acquire('scan:a:de', 'there:2', 60)
+        gengogettext.run_shared(None, ['a'], Mock(command='scan',
+                                                  languages=None))
+        walk_catalogs.assert_called_once_with([('fr', 'fr.po', None, ())])
+        self.assertEqual([json.loads(entry.job)['lc_tgt']
+                          for entry in Outbox.get_all_where('1')], ['fr'])
+
+    @patch('gengogettext.order')
+    def test_order_outbox(self, order, lease_owner):
+        jobs = [gengogettext.get_job_data(u'Hello', lang, False)
+                for lang in ('fr', 'de', 'es')]
+        gengogettext.queue_jobs(jobs)
+        # Ordered by another run, since it was queued
+        Job(1, 1, 'fr', u'Hello', u'', 'available').save()
+        order.side_effect = lambda jobs, orders_done, posted: jobs[1:]
+
+        gengogettext.order_outbox(True)
+        order.assert_called_once_with(jobs[1:], True, ANY)
+        self.assertEqual([json.loads(entry.job)
+                          for entry in Outbox.get_all_where('1')], jobs[2:])
+
+    @patch('gengogettext.order')
+    def test_posted_jobs_leave_the_outbox_straight_away(self, order,
+                                                        lease_owner):
+        jobs = [gengogettext.get_job_data(u'Hello', lang, False)
+                for lang in ('fr', 'de')]
+        gengogettext.queue_jobs(jobs)
+
+        unposted = []
+
+        def post(to_order, orders_done, posted):
+            posted(to_order[:1])
+            unposted.extend(to_order[1:])
+            raise KeyboardInterrupt()
+
+        order.side_effect = post
+        self.assertRaises(KeyboardInterrupt, gengogettext.order_outbox, True)
+        self.assertEqual(len(unposted), 1)
+        self.assertEqual([json.loads(entry.job)
+                          for entry in Outbox.get_all_where('1')], unposted)
+
+    @patch('gengogettext.CONCURRENCY', 1)
+    @patch('gengogettext.order')
+    @patch('gengogettext.gengo')
+    def test_resumed_orders_arent_ordered_again(self, gengo, order,
+                                                lease_owner):
+        gengogettext.queue_jobs([
+            gengogettext.get_job_data(u'Hello', 'fr', False)])
+        # Gave up waiting for it, when posting the queued job
+        Order(5, 1000).save()
+        gengo().getTranslationOrderJobs.return_value = {'response': {
+            'order': dict([('jobs_queued', '0'), ('jobs_available', ['7'])] +
+                          [(key, []) for key in gengogettext.ORDER_JOB_LISTS
+                           if key != 'jobs_available'])}}
+        gengo().getTranslationJobs.return_value = {'response': []}
+        gengo().getTranslationJobBatch.return_value = {'response': {'jobs': [
+            {'job_id': '7', 'status': 'available', 'body_src': u'Hello',
+             'lc_tgt': 'fr'}]}}
+        order.side_effect = lambda jobs, orders_done, posted: []
+
+        gengogettext.run_shared(None, [], Mock(command='order'))
+        self.assertEqual(Job.find('fr', u'Hello').id, 7)
+        order.assert_called_once_with([], True, ANY)
+        self.assertEqual(list(Outbox.get_all_where('1')), [])
+
+    @patch('gengogettext.LEASE_TTL', 0.3)
+    def test_lease_is_renewed(self, lease_owner):
+        # The renewer needs a DB it can open a connection of its own to
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        orm.DB_NAME = os.path.join(tmpdir, 'jobs.db')
+        with gengogettext.leased('order') as acquired:
+            self.assertTrue(acquired)
+            time.sleep(0.5)
+            self.assertFalse(Lease.acquire('order', 'there:2', 0.3))
+            self.assertGreater(Lease.get_where('1').expires, time.time())
+        self.assertIsNone(Lease.get_where('1'))
+
+    @patch('gengogettext.LEASE_TTL', 0.3)
+    @patch('gengogettext.LOST_LEASES', set())
+    @patch('gengogettext.order')
+    def test_lost_lease_stops_ordering(self, order, lease_owner):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        orm.DB_NAME = os.path.join(tmpdir, 'jobs.db')
+        gengogettext.queue_jobs([
+            gengogettext.get_job_data(u'Hello', 'fr', False)])
+        with gengogettext.leased('order'):
+            # As if this run had been stopped for longer than the TTL
+            Lease('order', 'there:2', time.time() + 60).save()
+            time.sleep(0.5)
+            self.assertEqual(gengogettext.LOST_LEASES, set(['order']))
+            gengogettext.order_outbox(True)
+        self.assertFalse(order.called)
+        self.assertEqual(len(list(Outbox.get_all_where('1'))), 1)
+        self.assertEqual(Lease.get_where('1').owner, 'there:2')
+
+
+class TestWatch(unittest.TestCase):
+    def test_callback(self):
+        job_ids = Queue.Queue()
+        server = callbacks.start_callback_server(0, job_ids)
+        try:
+            url = 'http://127.0.0.1:%i/' % server.server_address[1]
+            urllib2.urlopen(url, urllib.urlencode({
+                'job': json.dumps({'job_id': '12', 'status': 'approved'})}))
+            urllib2.urlopen(url, urllib.urlencode({'comment': '{}'}))
+        finally:
+            server.shutdown()
+        self.assertEqual(job_ids.get_nowait(), 12)
+        self.assertTrue(job_ids.empty())
+
+    @patch('gengogettext.CALLBACK_DELAY', 0)
+    def test_wait_for_callbacks(self):
+        job_ids = Queue.Queue()
+        self.assertIsNone(gengogettext.wait_for_callbacks(job_ids, 0))
+        job_ids.put(1)
+        job_ids.put(2)
+        self.assertEqual(gengogettext.wait_for_callbacks(job_ids, 0),
+                         set([1, 2]))
+
+    @patch('time.time', return_value=1000)
+    @patch('gengogettext.merge_approved')
+    @patch('gengogettext.update_statuses')
+    @patch('gengogettext.update_db')
+    @patch('gengogettext.resume_orders')
+    @patch('gengogettext.wait_for_callbacks')
+    @patch('gengogettext.walk_catalogs')
+    @patch('gengogettext.get_catalog_walks')
+    def watch(self, get_catalog_walks, walk_catalogs, wait_for_callbacks,
+              resume_orders, update_db, update_statuses, merge_approved,
+              time, cycles=1, update_db_effect=None, approvals=(),
+              merge_effect=None):
+        """Run watch() for cycles polls. Return the mocks"""
+        wait_for_callbacks.side_effect = [None] * cycles + [KeyboardInterrupt]
+        update_db.side_effect = update_db_effect
+        update_statuses.side_effect = list(approvals) + [[]] * cycles
+        merge_approved.side_effect = merge_effect
+        gengogettext.watch(None, [], None, 300)
+        return wait_for_callbacks, merge_approved
+
+    def test_retries_api_errors(self):
+        wait_for_callbacks, merge_approved = self.watch(
+            cycles=4,
+            update_db_effect=[GengoError('Down'), GengoError('Down'), None,
+                              None])
+        self.assertEqual(
+            [call[0][1] for call in wait_for_callbacks.call_args_list],
+            [0, 10, 20, 300, 300])
+
+    def test_retries_db_and_file_errors(self):
+        wait_for_callbacks, merge_approved = self.watch(
+            cycles=3,
+            update_db_effect=[sqlite3.OperationalError('database is locked'),
+                              IOError(13, 'Permission denied'), None])
+        self.assertEqual(
+            [call[0][1] for call in wait_for_callbacks.call_args_list],
+            [0, 10, 20, 300])
+
+    def test_keeps_approvals_that_werent_merged(self):
+        job = Job(1, 1, 'de', u'Hello', u'Hallo', 'approved')
+        wait_for_callbacks, merge_approved = self.watch(
+            cycles=2, approvals=[[job]],
+            merge_effect=[requests.Timeout('Slow'), None])
+        self.assertEqual(merge_approved.call_args[0][3], [job])
+        self.assertEqual(merge_approved.call_count, 2)
+
+    @patch('gengogettext.walk_catalogs')
+    @patch('gengogettext.get_catalog_walks')
+    def test_merge_only_affected_languages(self, get_catalog_walks,
+                                           walk_catalogs):
+        get_catalog_walks.return_value = iter([
+            ('fr', 'fr.po', None, ()),
+            ('de', 'de.po', None, ()),
+        ])
+        gengogettext.merge_approved(None, [], None, [
+            Job(1, 1, 'de', u'Hello', u'Hallo', 'approved')])
+        walk_catalogs.assert_called_once_with([('de', 'de.po', None, ())])
+
+
+@patch('gengogettext.gengo')
+class TestReviewQueue(DBTestCase):
+    def setUp(self):
+        super(TestReviewQueue, self).setUp()
+        Job.save_many([
+            Job(1, 1, 'fr', u'Hello', u'Bonjour', 'reviewable'),
+            Job(2, 1, 'fr', u'Hello %s', u'Bonjour', 'reviewable'),
+            Job(3, 1, 'fr', u'Bye %s', u'Salut', 'approved'),
+        ])
+
+    def test_queue(self, gengo):
+        gengo.return_value.getTranslationJobComments.return_value = {
+            'response': {'thread': [{'body': 'Hi'}]}}
+        jobs = gengogettext.queue_reviews()
+        self.assertEqual(sorted(jobs), [1, 2])
+        gengo.return_value.updateTranslationJob.assert_called_once_with(
+            id=1, action={'action': 'approve'})
+        review = Review.get_where('1')
+        self.assertEqual(review.job_id, 2)
+        self.assertEqual(json.loads(review.thread), [{'body': 'Hi'}])
+        self.assertIsNone(review.decision)
+
+    @patch('gengogettext.get_comments')
+    def test_comments_are_fetched_before_saving(self, get_comments, gengo):
+        saving = []
+        saved = []
+
+        def save_many(rows):
+            saving.append(True)
+            saved.extend(rows)
+
+        # Each thread records whether Review.save_many had started
+        get_comments.side_effect = lambda job: bool(saving)
+        with patch.object(Review, 'save_many', side_effect=save_many):
+            gengogettext.queue_reviews()
+        self.assertEqual([review.thread for review in saved], ['false'])
+
+    def test_queued_jobs_are_not_fetched_again(self, gengo):
+        Review(2, 'problem', '[]', None, None).save()
+        gengogettext.queue_reviews()
+        self.assertFalse(
+            gengo.return_value.getTranslationJobComments.called)
+
+    def test_prune(self, gengo):
+        Review(3, 'problem', '[]', 'approve', None).save()
+        Review(2, 'problem', '[]', None, None).save()
+        gengogettext.queue_reviews()
+        self.assertEqual(Review.get_queued_ids(), set([2]))
+
+    @patch('gengogettext.manual_review')
+    def test_decisions_are_stored(self, manual_review, gengo):
+        Review(2, 'problem', '[]', None, None).save()
+        manual_review.return_value = ('revise', 'Fix it')
+        gengogettext.decide_reviews({2: Job.get_where('id = 2')})
+        review = Review.get_where('job_id = 2')
+        self.assertEqual((review.decision, review.comment),
+                         ('revise', 'Fix it'))
+        self.assertFalse(gengo.called)
+
+    @patch('gengogettext.manual_review')
+    def test_skipped_jobs_stay_queued(self, manual_review, gengo):
+        Review(2, 'problem', '[]', None, None).save()
+        manual_review.return_value = (None, None)
+        gengogettext.decide_reviews({2: Job.get_where('id = 2')})
+        self.assertEqual([review.job_id for review in Review.get_undecided()],
+                         [2])
+
+    # Mocks don't record concurrent calls reliably
+    @patch('gengogettext.CONCURRENCY', 1)
+    def test_apply(self, gengo):
+        Review(1, 'problem', '[]', 'approve', None).save()
+        Review(2, 'problem', '[]', 'revise', 'Fix <it>').save()
+        jobs = gengogettext.queue_reviews()
+        gengo.reset_mock()
+        gengogettext.apply_reviews(jobs)
+        calls = gengo.return_value.updateTranslationJob.call_args_list
+        self.assertEqual(sorted(call[1]['id'] for call in calls), [1, 2])
+        self.assertIn(
+            ((), {'id': 2, 'action': {'action': 'revise',
+                                      'comment': 'Fix &lt;it&gt;'}}),
+            calls)
+        self.assertEqual(Review.get_queued_ids(), set())
+
+    def test_failed_decisions_stay_queued(self, gengo):
+        Review(2, 'problem', '[]', 'approve', None).save()
+        gengo.return_value.updateTranslationJob.side_effect = GengoError(
+            'Nope', 1)
+        gengogettext.apply_reviews({2: Job.get_where('id = 2')})
+        self.assertEqual(Review.get_queued_ids(), set([2]))
+
+
+class TestCheckRegistry(unittest.TestCase):
+    def setUp(self):
+        self.checks = list(gengogettext.CHECKS)
+        self.any_check = gengogettext._any_check
+
+    def tearDown(self):
+        gengogettext.CHECKS[:] = self.checks
+        gengogettext._any_check = self.any_check
+
+    def check_translation(self, source, translation):
+        Job = collections.namedtuple('Job', ('source', 'translation'))
+        return gengogettext.check_translation(Job(source, translation))
+
+    def test_plain_text(self):
+        self.assertIsNone(self.check_translation('Hello', 'Ciao'))
+
+    def test_registered_check(self):
+        gengogettext.register_check(r'\[\w+\]', '%(first_missing)s missing')
+        self.assertIsNone(self.check_translation('Hi [name]', 'Ciao [name]'))
+        self.assertIn('[name] missing',
+                      self.check_translation('Hi [name]', 'Ciao [nome]'))
+
+
 class TestLanguageMangling(unittest.TestCase):
     def test_unmangled_locale_to_gengo(self):
         self.assertEqual(gengogettext.locale_to_gengo_language('it'),
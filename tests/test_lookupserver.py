@@ -0,0 +1,125 @@
+# coding: utf-8
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib
+import urllib2
+
+from mock import patch
+
+import lookupserver
+import orm
+from lookupserver import LRUCache, TranslationStore
+from orm import Job
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        orm.db = None
+        orm.DB_NAME = os.path.join(self.dir, 'jobs.db')
+        Job.save_many([
+            Job(1, 1, 'fr', u'Hello', u'Bonjour', 'approved'),
+            Job(2, 1, 'fr', u'Hello', u'Salut', 'approved'),
+            Job(3, 1, 'fr', u'Bye', u'Au revoir', 'reviewable'),
+            Job(4, 1, 'de', u'Hello', u'Hallo', 'approved'),
+            Job(5, 1, 'fr', u'Café', u'Café', 'approved'),
+        ])
+        self.store = TranslationStore(orm.DB_NAME)
+
+    def tearDown(self):
+        self.store.close()
+        orm.db.close()
+        orm.db = None
+        shutil.rmtree(self.dir)
+
+
+class TestTranslationStore(StoreTestCase):
+    def test_lookup(self):
+        self.assertEqual(self.store.lookup('fr', u'Hello'), u'Bonjour')
+        self.assertEqual(self.store.lookup('de', u'Hello'), u'Hallo')
+        self.assertIsNone(self.store.lookup('fr', u'Bye'))
+        self.assertIsNone(self.store.lookup('es', u'Hello'))
+
+    @patch('lookupserver.LOOKUP_BATCH_SIZE', 2)
+    def test_lookup_many(self):
+        self.assertEqual(
+            self.store.lookup_many('fr', [u'Hello', u'Bye', u'Café']),
+            {u'Hello': u'Bonjour', u'Bye': None, u'Café': u'Café'})
+
+    def test_cached(self):
+        self.store.lookup_many('fr', [u'Hello', u'Bye'])
+        with patch.object(self.store, '_query') as query:
+            self.assertEqual(self.store.lookup_many('fr', [u'Hello', u'Bye']),
+                             {u'Hello': u'Bonjour', u'Bye': None})
+            query.assert_called_once_with('fr', [])
+
+    def test_reloads_new_approvals(self):
+        self.assertIsNone(self.store.lookup('fr', u'Bye'))
+        self.assertFalse(self.store.reload())
+        Job(3, 1, 'fr', u'Bye', u'Au revoir', 'approved').save()
+        self.assertEqual(self.store.lookup('fr', u'Bye'), u'Au revoir')
+
+    def test_read_only(self):
+        self.assertRaises(sqlite3.OperationalError, self.store.db.execute,
+                          'DELETE FROM job;')
+
+    def test_needs_migrated_database(self):
+        self.assertRaises(ValueError, TranslationStore,
+                          os.path.join(self.dir, 'empty.db'))
+
+
+class TestLookupServer(StoreTestCase):
+    def setUp(self):
+        super(TestLookupServer, self).setUp()
+        self.server = lookupserver.make_lookup_server(self.store,
+                                                      '127.0.0.1', 0)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%i/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestLookupServer, self).tearDown()
+
+    def get(self, path, data=None):
+        try:
+            response = urllib2.urlopen(self.url + path, data)
+        except urllib2.HTTPError as e:
+            response = e
+        return response.getcode(), json.load(response)
+
+    def test_lookup(self):
+        self.assertEqual(
+            self.get('translation?' + urllib.urlencode(
+                {'lang': 'fr', 'source': u'Café'.encode('utf-8')})),
+            (200, {'translation': u'Café'}))
+        self.assertEqual(
+            self.get('translation?lang=fr&source=Bye')[0], 404)
+        self.assertEqual(self.get('translation?lang=fr')[0], 400)
+
+    def test_batch_lookup(self):
+        self.assertEqual(
+            self.get('translations', json.dumps(
+                {'lang': 'fr', 'sources': ['Hello', 'Bye']})),
+            (200, {'translations': {'Hello': 'Bonjour', 'Bye': None}}))
+        self.assertEqual(
+            self.get('translations', json.dumps({'lang': 'fr'}))[0], 400)
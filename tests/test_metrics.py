@@ -0,0 +1,99 @@
+import json
+import unittest
+
+from mock import Mock, patch
+
+import orm
+from metrics import InstrumentedClient, Metrics, percentile
+from orm import Job
+from tests import DBTestCase
+
+
+class TestPercentile(unittest.TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 100)
+
+    def test_empty(self):
+        self.assertIsNone(percentile([], 0.5))
+
+
+class TestInstrumentedClient(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.gengo = Mock()
+        self.client = InstrumentedClient(self.gengo, self.metrics)
+
+    def test_records_calls(self):
+        self.gengo.getTranslationJobBatch.return_value = {'response': {}}
+        self.client.getTranslationJobBatch(id='1,2')
+        self.client.getTranslationJobBatch(id='3')
+        report = self.metrics.report()['api']['getTranslationJobBatch']
+        self.assertEqual(report['count'], 2)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['bytes_received'], 2 * len('{"response":{}}'))
+
+    def test_records_errors(self):
+        self.gengo.approve.side_effect = ValueError()
+        with self.assertRaises(ValueError):
+            self.client.approve(id=1)
+        self.assertEqual(self.metrics.report()['api']['approve']['errors'], 1)
+
+
+class TestReports(DBTestCase):
+    def setUp(self):
+        super(TestReports, self).setUp()
+        self.metrics = Metrics()
+        orm.on_query = self.metrics.record_query
+
+    def tearDown(self):
+        orm.on_query = None
+        super(TestReports, self).tearDown()
+
+    def test_queries(self):
+        Job.get_known_ids([1, 2])
+        Job.get_known_ids([1, 2, 3])
+        queries = self.metrics.report()['queries']
+        self.assertEqual(
+            queries['SELECT id FROM job WHERE id IN (?...);']['count'], 2)
+
+    def test_json(self):
+        with self.metrics.phase('scan'):
+            pass
+        report = json.loads(self.metrics.to_json())
+        self.assertIn('wall_seconds', report['phases']['scan'])
+
+    def test_queries_include_fetching_rows(self):
+        Job(1, 1, 'fr', u'Hello', u'Bonjour', 'approved').save()
+        ticks = iter(range(100, 200, 2))
+        with patch('time.time', lambda: next(ticks)):
+            list(Job.get_all_where('1'))
+        query = self.metrics.report()['queries'][
+            Job._select_sql % '1']
+        # Executing it, then fetching a page of rows, and then no more
+        self.assertEqual(query['total_seconds'], 6)
+
+    @patch('time.time')
+    def test_repeated_phases_add_up(self, time):
+        for start, end in ((100, 101), (200, 203)):
+            time.side_effect = [start, end]
+            with self.metrics.phase('sync'):
+                pass
+        phase = self.metrics.report()['phases']['sync']
+        self.assertEqual(phase['wall_seconds'], 4)
+        self.assertEqual(phase['count'], 2)
+
+    def test_prometheus(self):
+        with self.metrics.phase('scan'):
+            self.metrics.record_api_call('getTranslationJobs', 0.5, 10, 20)
+        text = self.metrics.to_prometheus()
+        self.assertIn('gengogettext_phase_wall_seconds{phase="scan"}', text)
+        self.assertIn('gengogettext_api_calls_total'
+                      '{method="getTranslationJobs"} 1.0', text)
+        self.assertIn('gengogettext_api_latency_seconds'
+                      '{method="getTranslationJobs",quantile="0.99"} 0.5',
+                      text)
+        self.assertIn('# TYPE gengogettext_api_latency_seconds summary', text)
+        self.assertIn('gengogettext_api_latency_seconds_count'
+                      '{method="getTranslationJobs"} 1.0', text)
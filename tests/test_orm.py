@@ -0,0 +1,192 @@
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+
+from mock import patch
+
+import orm
+from orm import Job, Lease, Order, Outbox
+from tests import DBTestCase
+
+
+class TestSave(DBTestCase):
+    def test_save_many(self):
+        Job.save_many(Job(id, 1, 'fr', 'source %i' % id, '', 'available')
+                      for id in range(10))
+        self.assertEqual(len(list(Job.get_all_where('1'))), 10)
+
+    def test_save_many_replaces(self):
+        Order(1, 100).save()
+        Order.save_many([Order(1, 200), Order(2, 300)])
+        self.assertEqual(Order.get_where('id = 1').created, 200)
+        self.assertEqual(Order.get_latest().id, 2)
+
+    def test_save_many_rolls_back(self):
+        rows = [Order(1, 100), Order(2, 200), object()]
+        with self.assertRaises(AttributeError):
+            Order.save_many(rows)
+        self.assertIsNone(Order.get_latest())
+
+    def test_statement_is_per_class(self):
+        self.assertIn('"job"', Job._replace_query())
+        self.assertIn('"order"', Order._replace_query())
+
+
+class TestRows(DBTestCase):
+    def test_slots(self):
+        job = Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved')
+        self.assertFalse(hasattr(job, '__dict__'))
+        with self.assertRaises(AttributeError):
+            job.foo = 'bar'
+
+    def test_read_rows(self):
+        job = Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved')
+        job.save()
+        self.assertEqual(Job.get_where('id = ?', (1,)), job)
+
+    def test_pickle(self):
+        job = Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(pickle.loads(pickle.dumps(job, protocol)), job)
+
+    def test_strings_are_interned(self):
+        Job.save_many([
+            Job(1, 1, 'fr', u'Hello', u'Bonjour', 'approved'),
+            Job(2, 1, 'de', u'Hello', u'Hallo', 'approved'),
+            Job(3, 1, 'es', u'Hello', u'', 'available'),
+        ])
+        self.assertEqual(
+            [row[0] for row in orm.get_db().execute(
+                'SELECT text FROM string ORDER BY text;')],
+            [u'', u'Bonjour', u'Hallo', u'Hello'])
+        self.assertEqual(Job.find('de', u'Hello').translation, u'Hallo')
+        self.assertIsNone(Job.find('it', u'Hello'))
+
+    def test_string_id(self):
+        self.assertEqual(orm.string_id('Hello'), orm.string_id(u'Hello'))
+        self.assertNotEqual(orm.string_id(u'Hello'), orm.string_id(u'hello'))
+        self.assertIsNone(orm.string_id(None))
+
+    def test_statements_are_per_class(self):
+        self.assertIn('"order"', Order._select_sql)
+        self.assertNotIn('"order"', Job._select_sql)
+
+
+class TestMigrations(DBTestCase):
+    def query_plan(self, query):
+        return ' '.join(row[-1] for row in
+                        orm.get_db().execute('EXPLAIN QUERY PLAN ' + query))
+
+    def test_new_database(self):
+        version = orm.get_db().execute('PRAGMA user_version;').fetchone()[0]
+        self.assertEqual(version, len(orm.MIGRATIONS))
+
+    def test_migrates_existing_database(self):
+        orm.db = sqlite3.connect(':memory:')
+        c = orm.db.cursor()
+        c.execute('CREATE TABLE "order" (id INTEGER PRIMARY KEY, '
+                  'created INTEGER);')
+        c.execute('INSERT INTO "order" VALUES (1, 100);')
+        orm.db.commit()
+        orm.migrate(orm.db)
+        self.assertEqual(Order.get_latest().created, 100)
+        self.assertIsNone(Job.get_where('1'))
+
+    def test_interns_existing_jobs(self):
+        orm.db = sqlite3.connect(':memory:')
+        c = orm.db.cursor()
+        for migration in orm.MIGRATIONS[:5]:
+            migration(c)
+        c.execute('PRAGMA user_version = 5;')
+        c.executemany('INSERT INTO job VALUES (?, ?, ?, ?, ?, ?);', [
+            (1, 1, 'fr', u'Hello', u'Bonjour', 'approved'),
+            (2, 1, 'de', u'Hello', u'', 'available'),
+            (3, 1, None, None, None, 'queued'),
+        ])
+        orm.db.commit()
+        orm.migrate(orm.db)
+        self.assertEqual(Job.find('fr', u'Hello'),
+                         Job(1, 1, 'fr', u'Hello', u'Bonjour', 'approved'))
+        self.assertEqual(Job.get_where('id = 3'),
+                         Job(3, 1, None, None, None, 'queued'))
+        self.assertEqual(
+            orm.db.execute('SELECT COUNT(*) FROM string;').fetchone()[0], 3)
+
+    def test_failed_migration_rolls_back(self):
+        def fail(cursor):
+            raise sqlite3.OperationalError('Nope')
+
+        orm.db = sqlite3.connect(':memory:')
+        with patch('orm.MIGRATIONS', orm.MIGRATIONS[:2] + [fail]):
+            self.assertRaises(sqlite3.OperationalError, orm.migrate, orm.db)
+        self.assertEqual(
+            orm.db.execute('PRAGMA user_version;').fetchone()[0], 0)
+        self.assertEqual(orm.db.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table';"
+        ).fetchone()[0], 0)
+
+    def test_migrated_once_by_concurrent_runs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'jobs.db')
+        first = sqlite3.connect(filename)
+        second = sqlite3.connect(filename)
+        orm.migrate(first)
+        # second saw version 0 before first migrated, but checks again
+        orm.migrate(second)
+        self.assertEqual(
+            second.execute('PRAGMA user_version;').fetchone()[0],
+            len(orm.MIGRATIONS))
+        first.close()
+        second.close()
+
+    def test_find_uses_index(self):
+        self.assertIn('job_lang_string', self.query_plan(
+            "SELECT * FROM job_text WHERE lang = 'fr' AND source_id = 1"))
+
+    def test_in_progress_uses_index(self):
+        self.assertIn('job_in_progress', self.query_plan(
+            "SELECT * FROM job WHERE status NOT IN ('approved', 'canceled')"))
+
+    def test_latest_order_uses_index(self):
+        self.assertIn('order_created', self.query_plan(
+            'SELECT MAX(created) FROM "order"'))
+
+
+@patch('time.time', return_value=1000)
+class TestLeases(DBTestCase):
+    def test_acquire(self, time):
+        self.assertTrue(Lease.acquire('scan', 'a', 60))
+        self.assertFalse(Lease.acquire('scan', 'b', 60))
+        self.assertTrue(Lease.acquire('sync', 'b', 60))
+
+    def test_renew(self, time):
+        Lease.acquire('scan', 'a', 60)
+        time.return_value = 1050
+        self.assertTrue(Lease.acquire('scan', 'a', 60))
+        self.assertEqual(Lease.get_where('1').expires, 1110)
+
+    def test_release(self, time):
+        Lease.acquire('scan', 'a', 60)
+        Lease.release('scan', 'b')
+        self.assertFalse(Lease.acquire('scan', 'b', 60))
+        Lease.release('scan', 'a')
+        self.assertTrue(Lease.acquire('scan', 'b', 60))
+
+    def test_take_over_expired(self, time):
+        Lease.acquire('scan', 'a', 60)
+        time.return_value = 1061
+        self.assertTrue(Lease.acquire('scan', 'b', 60))
+        self.assertFalse(Lease.acquire('scan', 'a', 60))
+
+
+class TestOutbox(DBTestCase):
+    def test_add_ignores_duplicates(self):
+        Outbox.add([Outbox('fr Hello', '{"n": 1}', 1),
+                    Outbox('de Hello', '{"n": 2}', 1)])
+        Outbox.add([Outbox('fr Hello', '{"n": 3}', 2)])
+        self.assertEqual(sorted(Outbox.get_all_where('1')),
+                         [Outbox('de Hello', '{"n": 2}', 1),
+                          Outbox('fr Hello', '{"n": 1}', 1)])
@@ -0,0 +1,63 @@
+import unittest
+
+from orm import Job
+from tm import TranslationMemory, match_whitespace, normalize
+
+
+class TestNormalize(unittest.TestCase):
+    def test_whitespace_and_case(self):
+        self.assertEqual(normalize(u'  Hello,\n  World '), u'hello, world')
+
+    def test_match_whitespace(self):
+        self.assertEqual(match_whitespace(u' Hello\n', u'Bonjour '),
+                         u' Bonjour\n')
+
+
+class TestTranslationMemory(unittest.TestCase):
+    def test_from_jobs(self):
+        memory = TranslationMemory.from_jobs([
+            Job(1, 1, 'fr', 'Hello', 'Bonjour', 'approved'),
+            Job(2, 1, 'fr', 'Bye', None, 'available'),
+            Job(3, 1, 'fr', 'Yes', 'Oui', 'canceled'),
+        ])
+        self.assertEqual(len(memory), 1)
+
+    def test_normalized_match(self):
+        memory = TranslationMemory(threshold=1)
+        memory.add(u'Hello world', u'Bonjour le monde')
+        self.assertEqual(memory.lookup(u'hello  World '),
+                         u'Bonjour le monde ')
+        self.assertIsNone(memory.lookup(u'Hello worlds'))
+
+    def test_fuzzy_match(self):
+        memory = TranslationMemory(threshold=0.8)
+        memory.add(u'Save your changes', u'Enregistrez vos modifications')
+        memory.add(u'Discard your changes', u'Annulez vos modifications')
+        self.assertEqual(memory.lookup(u'Save your changes.'),
+                         u'Enregistrez vos modifications')
+        self.assertIsNone(memory.lookup(u'Save the page'))
+
+    def test_best_fuzzy_match(self):
+        memory = TranslationMemory(threshold=0.5)
+        memory.add(u'Delete this page', u'Supprimer cette page')
+        memory.add(u'Delete this site', u'Supprimer ce site')
+        self.assertEqual(memory.lookup(u'Delete this site!'),
+                         u'Supprimer ce site')
+
+    def test_zero_threshold(self):
+        memory = TranslationMemory(threshold=0)
+        memory.add(u'Delete this page', u'Supprimer cette page')
+        memory.add(u'Bye', u'Salut')
+        self.assertEqual(memory.lookup(u'Delete it'),
+                         u'Supprimer cette page')
+        self.assertIsNotNone(memory.lookup(u'xyz'))
+
+    def test_threshold_range(self):
+        self.assertRaises(ValueError, TranslationMemory, threshold=1.5)
+        self.assertRaises(ValueError, TranslationMemory, threshold=-0.1)
+
+    def test_first_translation_wins(self):
+        memory = TranslationMemory()
+        memory.add(u'Hello', u'Bonjour')
+        memory.add(u'hello', u'Salut')
+        self.assertEqual(memory.lookup(u'Hello'), u'Bonjour')
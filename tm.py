@@ -0,0 +1,113 @@
+"""
+Translation memory: suggest existing translations for messages that
+differ only in whitespace or capitalization, or are merely similar.
+"""
+
+import collections
+import math
+import re
+
+
+def normalize(text):
+    """Collapse whitespace and case"""
+    return u' '.join(text.split()).lower()
+
+
+def trigrams(text):
+    text = u'  %s ' % text
+    return frozenset(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def match_whitespace(source, translation):
+    """Give translation the leading and trailing whitespace of source"""
+    m = re.match(r'^(\s*).*?(\s*)$', source, re.DOTALL)
+    return m.group(1) + translation.strip() + m.group(2)
+
+
+class TranslationMemory(object):
+    """
+    Translations for one language, indexed by normalized source text, and
+    by the trigrams in it, for fuzzy matches.
+    A fuzzy match needs a Dice coefficient of at least threshold, between
+    the trigrams of the normalized texts. With a threshold of 1, only
+    normalized matches are returned. With 0, the closest entry is, however
+    different.
+    """
+
+    def __init__(self, threshold=0.9):
+        if not 0 <= threshold <= 1:
+            raise ValueError('threshold must be between 0 and 1, not %r'
+                             % threshold)
+        self.threshold = threshold
+        self.exact = {}
+        # Entries are (trigrams, translation)
+        self.entries = []
+        # trigram -> entries
+        self.index = collections.defaultdict(list)
+
+    @classmethod
+    def from_jobs(cls, jobs, threshold=0.9):
+        """Build a memory from the approved jobs in jobs (a Job iterable)"""
+        memory = cls(threshold)
+        for job in jobs:
+            if job.status == 'approved' and job.translation:
+                memory.add(job.source, job.translation)
+        return memory
+
+    def __len__(self):
+        return len(self.exact)
+
+    def add(self, source, translation):
+        key = normalize(source)
+        if not key or key in self.exact:
+            return
+        self.exact[key] = translation
+        if self.threshold < 1:
+            grams = trigrams(key)
+            entry = len(self.entries)
+            self.entries.append((grams, translation))
+            for gram in grams:
+                self.index[gram].append(entry)
+
+    def lookup(self, source):
+        """Return a suggested translation for source, or None"""
+        key = normalize(source)
+        translation = self.exact.get(key)
+        if translation is None and self.threshold < 1:
+            translation = self.fuzzy_lookup(key)
+        if translation is None:
+            return None
+        return match_whitespace(source, translation)
+
+    def fuzzy_lookup(self, key):
+        grams = trigrams(key)
+        n = len(grams)
+        t = self.threshold
+        # A Dice coefficient >= t is only possible with entries of
+        # t / (2 - t) to (2 - t) / t times our number of trigrams, that
+        # share at least min_overlap of them with us. So they have to share
+        # one of our (n - min_overlap + 1) rarest trigrams. Only look there.
+        if t == 0:
+            # Everything matches, even entries with no trigrams in common
+            shortest, longest = 0, float('inf')
+            candidates = range(len(self.entries))
+        else:
+            shortest = math.ceil(n * t / (2 - t))
+            longest = n * (2 - t) / t
+            min_overlap = int(math.ceil(t * n / (2 - t)))
+            postings = sorted((self.index.get(gram, ()) for gram in grams),
+                              key=len)
+            candidates = set()
+            for posting in postings[:n - min_overlap + 1]:
+                candidates.update(posting)
+
+        best, best_score = None, t
+        for entry in candidates:
+            entry_grams, translation = self.entries[entry]
+            length = len(entry_grams)
+            if not shortest <= length <= longest:
+                continue
+            score = 2.0 * len(grams & entry_grams) / (n + length)
+            if score >= best_score:
+                best, best_score = translation, score
+        return best